@@ -1,7 +1,46 @@
-from flask import Flask
+import time
+from flask import Flask, request
 from app.routes import routes
+from app import metrics, services, jobs
+from app.config import WARM_UP
 
-def create_app():
+def create_app(warm_up=WARM_UP):
+    """
+    Builds the Flask app. With warm_up (WARM_UP in the environment) storage
+    connections and the metadata cache are primed before it is returned, so
+    the first requests a worker serves do not pay for them. Warming up once
+    in a parent that forks its workers (gunicorn --preload) is safe: a forked
+    child replaces the parent's I/O pools, writer threads and storage client.
+    With a persistent job store the job workers start here too.
+    """
     app = Flask(__name__)
     app.register_blueprint(routes)
+    if metrics.ENABLED:
+        register_metrics(app)
+    if warm_up:
+        start = time.perf_counter()
+        try:
+            packages = services.warm_up()
+            print(f"Warm-up cached {packages} packages in {time.perf_counter() - start:.3f}s")
+        except Exception as e:
+            # A worker that cannot reach storage yet still starts and retries on demand
+            print(f"Warm-up failed: {e}")
+    jobs.job_workers.start_persistent()
     return app
+
+def register_metrics(app):
+    """ Times every request; streamed responses are finished when the client has read them """
+    @app.before_request
+    def start_request():
+        metrics.start_request()
+
+    @app.after_request
+    def finish_request(response):
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        method, path = request.method, request.path
+        finish = lambda: metrics.finish_request(method, route, response.status_code, path)
+        if response.is_streamed:
+            response.call_on_close(finish)
+        else:
+            finish()
+        return response
@@ -0,0 +1,86 @@
+import json
+import re
+import time
+import uuid
+from datetime import datetime, timezone
+from app.config import CHANGE_FEED_SETTLE
+from app.services import storage, list_objects, run_concurrently, upload_to_s3
+
+# Every event is one object under an hourly segment of the change log:
+# changes/<YYYYMMDDHH>/<cursor>.json. A cursor starts with the event's time in
+# nanoseconds, so keys sort in event order across segments and the events
+# after a cursor are a single listing that starts after its key.
+CHANGES_PREFIX = "changes/"
+
+CREATED, VERSION, DELETED = "created", "version", "deleted"
+
+CURSOR_PATTERN = re.compile(r"^[0-9]{19}-[0-9a-f]{8}$")
+
+
+def _segment(timestamp_ns):
+    return datetime.fromtimestamp(timestamp_ns / 1e9, tz=timezone.utc).strftime("%Y%m%d%H")
+
+
+def _cursor_key(cursor):
+    return f"{CHANGES_PREFIX}{_segment(int(cursor[:19]))}/{cursor}.json"
+
+
+def is_cursor(value):
+    return bool(CURSOR_PATTERN.match(value))
+
+
+def append_change(event_type, package_id, **fields):
+    """
+    Appends an event to the change log; returns it with its cursor.
+    - event_type: CREATED, VERSION or DELETED
+    - fields: extra fields of the event, e.g. version and name
+    """
+    timestamp_ns = time.time_ns()
+    cursor = f"{timestamp_ns:019d}-{uuid.uuid4().hex[:8]}"
+    event = {
+        "cursor": cursor,
+        "type": event_type,
+        "package_id": package_id,
+        "timestamp": datetime.fromtimestamp(timestamp_ns / 1e9, tz=timezone.utc).isoformat(),
+        **fields
+    }
+    upload_to_s3(json.dumps(event).encode("utf-8"), _cursor_key(cursor), "json")
+    return event
+
+
+def record_upload(metadata, previous_latest, revert_of=None):
+    """ Logs a new version of a package, as its creation if it had no version before """
+    fields = {"version": metadata["latest"], "name": metadata.get("name")}
+    if revert_of:
+        fields["revert_of"] = revert_of
+    return append_change(VERSION if previous_latest else CREATED, metadata["identifier"], **fields)
+
+
+def read_changes(since=None, limit=100):
+    """
+    Returns up to limit events after the since cursor (from the start of the
+    log without one), oldest first, and whether more are available.
+
+    Events younger than CHANGE_FEED_SETTLE seconds are held back: a writer
+    stamps an event before storing it, so an event with an earlier cursor may
+    still become visible after a later one. Once it is older than the settle
+    time no earlier event can appear, so a consumer that resumes from the
+    last cursor it saw never misses one.
+    """
+    settled_before = f"{time.time_ns() - int(CHANGE_FEED_SETTLE * 1e9):019d}"
+    keys = []
+    more = False
+    for obj in list_objects(CHANGES_PREFIX, start_after=_cursor_key(since) if since else None):
+        cursor = obj["Key"].rsplit("/", 1)[-1][:-len(".json")]
+        if cursor >= settled_before:
+            break
+        if len(keys) == limit:
+            more = True
+            break
+        keys.append(obj["Key"])
+
+    events = run_concurrently(*[
+        lambda key=key: json.loads(storage.get(key)["Body"].read().decode("utf-8"))
+        for key in keys
+    ])
+    return events, more
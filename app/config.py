@@ -8,3 +8,48 @@ AWS_REGION = os.getenv("AWS_REGION")
 AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
 AWS_SECRET_KEY = os.getenv("AWS_SECRET_KEY")
 ADDITIONAL_IDENTIFIERS_ALLOW = os.getenv("ADDITIONAL_IDENTIFIERS_ALLOW").split(',') if os.getenv("ADDITIONAL_IDENTIFIERS_ALLOW") else []
+PACKAGE_LIST_SHARDS = int(os.getenv("PACKAGE_LIST_SHARDS", 16))
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", 1024))
+METADATA_CACHE_TTL = float(os.getenv("METADATA_CACHE_TTL", 30))
+INGEST_CHUNK_ROWS = int(os.getenv("INGEST_CHUNK_ROWS", 50000))
+MULTIPART_PART_SIZE = int(os.getenv("MULTIPART_PART_SIZE", 8 * 1024 * 1024))
+ISSN_IDENTIFIER_COLUMNS = os.getenv("ISSN_IDENTIFIER_COLUMNS", "print_identifier").split(',')
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", 64 * 1024))
+ROW_KEY_COLUMNS = os.getenv("ROW_KEY_COLUMNS", "title_id,print_identifier,online_identifier,publication_title").split(",")
+OFFSET_INDEX_EVERY = int(os.getenv("OFFSET_INDEX_EVERY", 1000))
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 50))
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", 5))
+S3_CONNECT_TIMEOUT = float(os.getenv("S3_CONNECT_TIMEOUT", 5))
+S3_READ_TIMEOUT = float(os.getenv("S3_READ_TIMEOUT", 60))
+S3_IO_WORKERS = int(os.getenv("S3_IO_WORKERS", 16))
+MULTIPART_MAX_IN_FLIGHT = int(os.getenv("MULTIPART_MAX_IN_FLIGHT", 2))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", 4))
+BATCH_SPOOL_SIZE = int(os.getenv("BATCH_SPOOL_SIZE", 32 * 1024 * 1024))
+ASYNC_UPLOADS = os.getenv("ASYNC_UPLOADS", "false").lower() == "true"
+JOB_BACKEND = os.getenv("JOB_BACKEND", "memory")
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 2))
+JOB_LEASE = float(os.getenv("JOB_LEASE", 60))
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", 24 * 3600))
+JSON_GZIP_LEVEL = int(os.getenv("JSON_GZIP_LEVEL", 6))
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", 1024))
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL", None)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3")
+LOCAL_STORAGE_PATH = os.getenv("LOCAL_STORAGE_PATH", "data")
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", 0))
+WARM_UP = os.getenv("WARM_UP", "false").lower() == "true"
+WARM_UP_PACKAGES = int(os.getenv("WARM_UP_PACKAGES", 100))
+PRESIGNED_URL_EXPIRY = int(os.getenv("PRESIGNED_URL_EXPIRY", 3600))
+PRESIGNED_URL_MIN_REMAINING = int(os.getenv("PRESIGNED_URL_MIN_REMAINING", 300))
+PRESIGNED_URL_CACHE_SIZE = int(os.getenv("PRESIGNED_URL_CACHE_SIZE", 4096))
+CHANGE_FEED_SETTLE = float(os.getenv("CHANGE_FEED_SETTLE", 5))
+CHANGE_FEED_MAX_LIMIT = int(os.getenv("CHANGE_FEED_MAX_LIMIT", 1000))
+EXPORT_PREFETCH = int(os.getenv("EXPORT_PREFETCH", 8))
+EXPORT_BUFFER_SIZE = int(os.getenv("EXPORT_BUFFER_SIZE", 8 * 1024 * 1024))
+CONDITIONAL_WRITE_ATTEMPTS = int(os.getenv("CONDITIONAL_WRITE_ATTEMPTS", 10))
+CONDITIONAL_WRITE_BACKOFF = float(os.getenv("CONDITIONAL_WRITE_BACKOFF", 0.02))
+VERSION_CLAIM_ATTEMPTS = int(os.getenv("VERSION_CLAIM_ATTEMPTS", 50))
+INDEX_WRITE_DELAY = float(os.getenv("INDEX_WRITE_DELAY", 0.05))
+INDEX_WRITE_MAX_BATCH = int(os.getenv("INDEX_WRITE_MAX_BATCH", 100))
@@ -0,0 +1,82 @@
+import threading
+import time
+from concurrent.futures import Future
+
+
+class WriteCoordinator:
+    """
+    Debounces and coalesces writes to a shared index. Changes submitted
+    within `delay` seconds of the first pending one (or until max_batch are
+    pending) are handed together, in submission order, to a single call of
+    apply(changes) on a background thread, so a burst of uploads rewrites
+    each index object once instead of once per upload.
+    submit() returns a Future that completes when the batch holding the
+    change has been written, or raises what apply raised.
+    """
+
+    def __init__(self, apply, delay, max_batch, name="index-writer"):
+        self.apply = apply
+        self.delay = delay
+        self.max_batch = max_batch
+        self.name = name
+        self.pending = []
+        self.first_pending = None
+        self.condition = threading.Condition()
+        self.thread = None
+        self.submitted = 0
+        self.batches = 0
+
+    def submit(self, change):
+        future = Future()
+        with self.condition:
+            if not self.pending:
+                self.first_pending = time.monotonic()
+            self.pending.append((change, future))
+            self.submitted += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return future
+
+    def reset_after_fork(self):
+        """
+        Forgets the writer thread and pending changes of the parent process; a
+        forked child inherits neither the thread nor anyone waiting on them
+        """
+        self.condition = threading.Condition()
+        self.pending = []
+        self.first_pending = None
+        self.thread = None
+
+    def submit_all(self, changes):
+        """ Submits changes and waits until all of them have been written """
+        for future in [self.submit(change) for change in changes]:
+            future.result()
+
+    def _next_batch(self):
+        with self.condition:
+            while True:
+                if self.pending:
+                    remaining = self.first_pending + self.delay - time.monotonic()
+                    if remaining <= 0 or len(self.pending) >= self.max_batch:
+                        break
+                    self.condition.wait(remaining)
+                else:
+                    self.condition.wait()
+            batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            self.first_pending = time.monotonic() if self.pending else None
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self.apply([change for change, future in batch])
+            except Exception as e:
+                for change, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            for change, future in batch:
+                future.set_result(None)
@@ -0,0 +1,161 @@
+import io
+import json
+import tarfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from app.config import PACKAGE_LIST_SHARDS, EXPORT_PREFETCH, EXPORT_BUFFER_SIZE, STREAM_CHUNK_SIZE, JSON_GZIP_LEVEL
+from app.services import storage, read_package_list_shard, migrate_package_list, PACKAGE_LIST_PREFIX
+from app.metrics import propagate
+from app.storage import NotFound
+
+
+def iter_packages():
+    """ Yields the metadata of every package, one package list shard at a time """
+    migrate_package_list()
+    for shard in range(PACKAGE_LIST_SHARDS):
+        packages = read_package_list_shard(f"{PACKAGE_LIST_PREFIX}{shard:02x}.json")
+        yield from sorted(packages, key=lambda package: package.get("identifier", ""))
+
+
+class _Titles:
+    """
+    The data.json of a package's latest version, fetched ahead of its turn.
+    Objects up to EXPORT_BUFFER_SIZE bytes are read into memory; larger ones
+    keep their open body, which is streamed when the package is written.
+    """
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.size = None
+        self.data = None
+        self.body = None
+        self.error = None
+        key = f"packages/{metadata['identifier']}/versions/{metadata.get('latest')}/data.json"
+        try:
+            obj = storage.get(key)
+        except NotFound:
+            self.error = f"Title list not found: {key}"
+            return
+        self.size = obj["ContentLength"]
+        if self.size <= EXPORT_BUFFER_SIZE:
+            self.data = obj["Body"].read()
+            obj["Body"].close()
+        else:
+            self.body = obj["Body"]
+
+    def chunks(self):
+        if self.data is not None:
+            yield self.data
+        elif self.body is not None:
+            try:
+                yield from self.body.iter_chunks(STREAM_CHUNK_SIZE)
+            finally:
+                self.close()
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+
+def prefetch_titles(packages, window=EXPORT_PREFETCH):
+    """
+    Yields a _Titles for each package metadata in order, keeping up to window
+    title lists in flight on a pool of its own, so the export is paced by
+    transfer rather than by the latency of each GET and at most window
+    buffered objects are held at once.
+    """
+    pool = ThreadPoolExecutor(max_workers=window, thread_name_prefix="export")
+    pending = deque()
+    packages = iter(packages)
+    try:
+        while True:
+            while len(pending) < window:
+                metadata = next(packages, None)
+                if metadata is None:
+                    break
+                pending.append(pool.submit(propagate(_Titles), metadata))
+            if not pending:
+                return
+            yield pending.popleft().result()
+    finally:
+        # The client went away or the export failed: drop what was fetched ahead
+        for future in pending:
+            if not future.cancel():
+                try:
+                    future.result().close()
+                except Exception:
+                    pass
+        pool.shutdown(wait=False)
+
+
+def ndjson_chunks(packages):
+    """
+    One line per package: {"metadata": {...}, "titles": [...]}. The stored
+    data.json is copied verbatim into the line rather than re-encoded; it is
+    a single line of JSON as written at ingest.
+    """
+    for titles in prefetch_titles(packages):
+        yield b'{"metadata": ' + json.dumps(titles.metadata).encode("utf-8") + b', "titles": '
+        if titles.error:
+            yield b'null, "error": ' + json.dumps(titles.error).encode("utf-8")
+        else:
+            yield from titles.chunks()
+        yield b"}\n"
+
+
+def _tar_member(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def _tar_padding(size):
+    return b"\0" * (-size % tarfile.BLOCKSIZE)
+
+
+def tar_chunks(packages):
+    """
+    A tar with <package_id>/metadata.json and <package_id>/data.json per
+    package. Headers are written by hand so a title list is streamed into the
+    archive as it arrives instead of being held in memory by tarfile.
+    """
+    written = 0
+    now = int(time.time())
+    for titles in prefetch_titles(packages):
+        package_id = titles.metadata["identifier"]
+        metadata = json.dumps(titles.metadata).encode("utf-8")
+        for chunk in (_tar_member(f"{package_id}/metadata.json", len(metadata), now), metadata, _tar_padding(len(metadata))):
+            written += len(chunk)
+            yield chunk
+        if titles.error:
+            continue
+        header = _tar_member(f"{package_id}/data.json", titles.size, now)
+        written += len(header)
+        yield header
+        for chunk in titles.chunks():
+            written += len(chunk)
+            yield chunk
+        padding = _tar_padding(titles.size)
+        written += len(padding)
+        yield padding
+    # Two empty blocks end the archive, which is then padded to a whole record like tarfile does
+    end = b"\0" * (2 * tarfile.BLOCKSIZE)
+    yield end + b"\0" * (-(written + len(end)) % tarfile.RECORDSIZE)
+
+
+def gzip_chunks(chunks):
+    """ Compresses a stream of chunks into a single gzip member, flushing every STREAM_CHUNK_SIZE bytes of output """
+    compressor = zlib.compressobj(JSON_GZIP_LEVEL, zlib.DEFLATED, 31)
+    buffer = io.BytesIO()
+    for chunk in chunks:
+        buffer.write(compressor.compress(chunk))
+        if buffer.tell() >= STREAM_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer = io.BytesIO()
+    buffer.write(compressor.flush())
+    yield buffer.getvalue()
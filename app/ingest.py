@@ -0,0 +1,511 @@
+import io
+import hashlib
+import json
+import tempfile
+import zlib
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from app.config import S3_BUCKET, INGEST_CHUNK_ROWS, ROW_KEY_COLUMNS, OFFSET_INDEX_EVERY, JSON_GZIP_LEVEL
+from app.services import (
+    MultipartUpload, upload_to_s3, read_row_hashes, run_concurrently, generate_package_id,
+    get_package_metadata, version_checksums, list_version_numbers, package_versions, update_title_index, update_package_list, storage,
+    claim_version, release_version, update_json, metadata_cache
+)
+from app.changes import record_upload
+from app.metrics import record, span, timed
+from app.stats import empty_stats, chunk_stats, add_stats
+from app.validations import format_validation_result
+from app.validations import validate_dataframe, normalize_issns
+
+class IngestError(Exception):
+    """ Raised when an uploaded file cannot be read or converted """
+
+
+class _TeeReader(io.RawIOBase):
+    """ Raw stream that hashes every byte read from the upload and copies it to the TSV upload """
+
+    def __init__(self, stream, tsv_upload):
+        self.stream = stream
+        self.tsv_upload = tsv_upload
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.stream.read(len(buffer))
+        self.md5.update(data)
+        self.size += len(data)
+        self.tsv_upload.write(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class _ParquetSink:
+    """ Write-only file object that feeds a ParquetWriter into a MultipartUpload """
+
+    def __init__(self, upload):
+        self.upload = upload
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.upload.write(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def as_text_columns(chunk):
+    """
+    Converts a parsed chunk to nullable string columns for data.json and the
+    columnar copy. Every chunk then has the same schema whatever pandas
+    inferred for it, and whole floats (integers widened by missing values)
+    are written without ".0".
+    """
+    columns = {}
+    for column in chunk.columns:
+        values = chunk[column]
+        if pd.api.types.is_float_dtype(values) and (values.dropna() % 1 == 0).all():
+            values = values.astype("Int64")
+        columns[str(column)] = values.astype("string")
+    return pd.DataFrame(columns, index=chunk.index)
+
+
+def row_hashes(text_chunk, key_columns):
+    """
+    Returns stable 64-bit hashes of a chunk whose columns are all text:
+    one over the key columns that identify a title and one over the whole row.
+    """
+    keys = pd.util.hash_pandas_object(text_chunk[key_columns], index=False).to_numpy()
+    rows = pd.util.hash_pandas_object(text_chunk, index=False).to_numpy()
+    return keys, rows
+
+
+class TsvIngest:
+    """
+    Single-pass ingest of an uploaded KBART TSV.
+
+    The upload is parsed in chunks of INGEST_CHUNK_ROWS rows. Each chunk is
+    checksummed, validated, counted for the version's statistics and encoded
+    as it is read, and its normalized ISSNs are collected for the title index. The raw TSV, the JSON
+    title list (plain and gzip-compressed, so it can be served precompressed)
+    and a Parquet copy (one row group per chunk) are streamed to
+    S3 as multipart uploads, so peak memory does not depend on the size of
+    the file. A sidecar offsets.json records the byte offset in data.json of
+    every OFFSET_INDEX_EVERY-th title so pages can be read with ranged GETs.
+
+    Per-row hashes are stored next to the version and, when there is a
+    previous_version, compared with its hashes to build a manifest of added,
+    changed and removed rows.
+    Nothing becomes visible in S3 until commit() is called.
+    """
+
+    def __init__(self, stream, package_id, version, previous_version=None):
+        self.stream = stream
+        self.version = version
+        self.previous_version = previous_version
+        version_prefix = f"packages/{package_id}/versions/{version}/"
+        self.previous_prefix = f"packages/{package_id}/versions/{previous_version}/" if previous_version else None
+        self.version_prefix = version_prefix
+        self.json_upload = MultipartUpload(f"{version_prefix}data.json", "application/json")
+        self.gzip_upload = MultipartUpload(f"{version_prefix}data.json.gz", "application/gzip")
+        self.gzip_compressor = zlib.compressobj(JSON_GZIP_LEVEL, zlib.DEFLATED, 31)
+        self.json_size = 0
+        self.offsets = []
+        self.tsv_upload = MultipartUpload(f"{version_prefix}raw.tsv", "text/tab-separated-values")
+        self.parquet_upload = MultipartUpload(f"{version_prefix}data.parquet", "application/vnd.apache.parquet")
+        self.parquet_writer = None
+        self.hashes_upload = MultipartUpload(f"{version_prefix}row_hashes.parquet", "application/vnd.apache.parquet")
+        self.hashes_writer = None
+        self.diff_upload = MultipartUpload(f"{version_prefix}diff.json", "application/json")
+        self.has_diff = False
+        self.previous_hashes = None
+        self.candidates = None
+        self.checksum = None
+        self.title_count = 0
+        self.errors = []
+        self.warnings = []
+        self.issns = set()
+        self.stats = empty_stats()
+
+    def run(self):
+        """ Reads the whole upload; raises IngestError if it cannot be parsed """
+        tee = _TeeReader(self.stream, self.tsv_upload)
+        reader = io.BufferedReader(tee)
+
+        try:
+            chunks = pd.read_csv(reader, sep="\t", chunksize=INGEST_CHUNK_ROWS)
+        except Exception as e:
+            raise IngestError(f"Error reading TSV: {e}")
+
+        previous = read_row_hashes(self.previous_prefix) if self.previous_prefix else None
+        if previous is not None:
+            # Only the hashes are held in memory, the previous key columns stay in the file
+            self.previous_hashes = previous
+            previous_table = previous.read(columns=["key", "row"])
+            previous_keys, previous_row_hashes = previous_table["key"].to_numpy(), previous_table["row"].to_numpy()
+            order = np.argsort(previous_row_hashes, kind="stable")
+            previous_rows = previous_row_hashes[order]
+            previous_matched = np.zeros(len(order), dtype=bool)
+            # Rows the previous version does not have, one JSON record per line
+            self.candidates = tempfile.TemporaryFile()
+            candidate_keys, candidate_rows = [], []
+
+        self._write_json(b"[")
+        while True:
+            try:
+                with span("parse"):
+                    chunk = next(chunks)
+            except StopIteration:
+                break
+            except Exception as e:
+                raise IngestError(f"Error reading TSV: {e}")
+
+            with span("validate"):
+                errors, warnings = validate_dataframe(chunk, start=self.title_count)
+            self.errors.extend(errors)
+            self.warnings.extend(warnings)
+
+            # pandas infers types per chunk, so a sparse numeric column can be int
+            # in one chunk and float in the next; the text form is the same in all
+            text_chunk = as_text_columns(chunk)
+            try:
+                with span("json_encode"):
+                    chunk_json = text_chunk.to_json(orient="records", lines=True).encode("utf-8")
+            except Exception as e:
+                raise IngestError(f"Error converting to JSON: {e}")
+
+            # Splice the chunk's records into the single JSON array of the file,
+            # recording the byte offset of every OFFSET_INDEX_EVERY-th record
+            if len(chunk):
+                with span("json_write"):
+                    records = chunk_json.rstrip(b"\n")
+                    separator = b"," if self.title_count else b""
+                    newlines = np.flatnonzero(np.frombuffer(records, dtype=np.uint8) == ord("\n"))
+                    starts = np.concatenate(([0], newlines + 1)) + self.json_size + len(separator)
+                    first = -self.title_count % OFFSET_INDEX_EVERY
+                    self.offsets.extend(starts[first::OFFSET_INDEX_EVERY].tolist())
+                    self._write_json(separator + records.replace(b"\n", b","))
+            self.title_count += len(chunk)
+
+            for column in ("print_identifier", "online_identifier"):
+                if column in chunk.columns:
+                    self.issns.update(normalize_issns(chunk[column]).tolist())
+
+            with span("stats"):
+                add_stats(self.stats, chunk_stats(chunk))
+
+            with span("parquet_encode"):
+                table = pa.Table.from_pandas(text_chunk, preserve_index=False)
+                if self.parquet_writer is None:
+                    self.parquet_writer = pq.ParquetWriter(
+                        pa.PythonFile(_ParquetSink(self.parquet_upload), mode="w"),
+                        table.schema
+                    )
+                self.parquet_writer.write_table(table)
+
+            with span("row_hashes"):
+                key_columns = [column for column in ROW_KEY_COLUMNS if column in text_chunk.columns] or list(text_chunk.columns)
+                keys, rows = row_hashes(text_chunk, key_columns)
+                hashes = pa.Table.from_pandas(
+                    text_chunk[key_columns].assign(key=keys, row=rows),
+                    preserve_index=False
+                )
+                if self.hashes_writer is None:
+                    self.hashes_writer = pq.ParquetWriter(
+                        pa.PythonFile(_ParquetSink(self.hashes_upload), mode="w"),
+                        hashes.schema
+                    )
+                self.hashes_writer.write_table(hashes)
+
+            # Rows whose hash the previous version does not have were added or changed
+            if previous is not None and len(previous_rows):
+                positions = np.minimum(np.searchsorted(previous_rows, rows), len(previous_rows) - 1)
+                found = previous_rows[positions] == rows
+                previous_matched[positions[found]] = True
+            else:
+                found = np.zeros(len(rows), dtype=bool)
+            if previous is not None and not found.all():
+                records = text_chunk[~found].to_json(orient="records", lines=True).encode("utf-8")
+                self.candidates.write(records.rstrip(b"\n") + b"\n")
+                candidate_keys.append(keys[~found])
+                candidate_rows.append(rows[~found])
+        self.offsets.append(self.json_size)
+        self._write_json(b"]")
+        self.gzip_upload.write(self.gzip_compressor.flush())
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            self.hashes_writer.close()
+
+        if previous is not None:
+            candidate_keys, candidate_rows = (
+                np.concatenate(parts) if parts else np.array([], dtype=np.uint64)
+                for parts in (candidate_keys, candidate_rows)
+            )
+            with span("diff"):
+                self._write_diff(
+                    previous_keys, previous_row_hashes, order[~previous_matched], candidate_keys, candidate_rows
+                )
+
+        # Make sure the raw copy and checksum cover any bytes the parser left unread
+        while reader.read(io.DEFAULT_BUFFER_SIZE):
+            pass
+        self.checksum = tee.md5.hexdigest()
+        record("ingest", rows=self.title_count, size=tee.size)
+        record("json", size=self.json_size)
+        return self
+
+    def _write_json(self, data):
+        self.json_upload.write(data)
+        self.gzip_upload.write(self.gzip_compressor.compress(data))
+        self.json_size += len(data)
+
+    def _write_diff(self, previous_keys, previous_rows, unmatched, candidate_keys, candidate_rows):
+        """
+        Streams diff.json, pairing new rows missing from the previous version
+        (the spooled candidates) with previous rows missing from this one
+        (unmatched positions in its hash table): a shared key is a change, the
+        rest were added or removed. Removed keys are read from the previous
+        hash table a row group at a time.
+        "row_hashes" holds the hash of each entry's row before ("removed"),
+        after ("added") or both ("changed"), so compose_diff can tell a row
+        changed back to what it was from one that changed.
+        """
+        changed = np.isin(candidate_keys, previous_keys[unmatched])
+        removed = np.zeros(len(previous_keys), dtype=bool)
+        removed[unmatched] = True
+        removed &= ~np.isin(previous_keys, candidate_keys[changed])
+
+        by_key = np.argsort(previous_keys[unmatched], kind="stable")
+        replaced = unmatched[by_key[np.searchsorted(previous_keys[unmatched][by_key], candidate_keys[changed])]]
+        row_hashes = {
+            "added": candidate_rows[~changed],
+            "changed": np.stack([previous_rows[replaced], candidate_rows[changed]], axis=1),
+            "removed": previous_rows[removed]
+        }
+
+        def candidate_lines(selected):
+            self.candidates.seek(0)
+            yield from (line for line, keep in zip(self.candidates, selected) if keep)
+
+        def removed_lines():
+            key_columns = [name for name in self.previous_hashes.schema_arrow.names if name not in ("key", "row")]
+            start = 0
+            for batch in self.previous_hashes.iter_batches(columns=key_columns):
+                selected = removed[start:start + batch.num_rows]
+                start += batch.num_rows
+                if selected.any():
+                    rows = batch.filter(pa.array(selected)).to_pandas()
+                    yield from rows.to_json(orient="records", lines=True).encode("utf-8").rstrip(b"\n").split(b"\n")
+
+        self.diff_upload.write(json.dumps({"from": self.previous_version, "to": self.version})[:-1].encode("utf-8"))
+        for name, lines in (("added", candidate_lines(~changed)), ("changed", candidate_lines(changed)), ("removed", removed_lines())):
+            self.diff_upload.write(f', "{name}": ['.encode("utf-8"))
+            for n, line in enumerate(lines):
+                self.diff_upload.write((b", " if n else b"") + line.rstrip(b"\n"))
+            self.diff_upload.write(b"]")
+        self.diff_upload.write(b', "row_hashes": {')
+        for n, (name, hashes) in enumerate(row_hashes.items()):
+            self.diff_upload.write(f'{", " if n else ""}"{name}": ['.encode("utf-8"))
+            for start in range(0, len(hashes), INGEST_CHUNK_ROWS):
+                hex_hashes = np.char.mod("%016x", hashes[start:start + INGEST_CHUNK_ROWS]).tolist()
+                self.diff_upload.write((", " if start else "") + json.dumps(hex_hashes)[1:-1])
+            self.diff_upload.write(b"]")
+        self.diff_upload.write(b"}}")
+        self.has_diff = True
+        self._close_previous()
+
+    def _close_previous(self):
+        if self.candidates is not None:
+            self.candidates.close()
+        if self.previous_hashes is not None:
+            self.previous_hashes.close(force=True)
+
+    @timed("commit_uploads")
+    def commit(self):
+        """
+        Completes the uploads of the version concurrently.
+        Returns the files of the version as metadata.json lists them, e.g. {"json": "s3://..."}.
+        """
+        offsets = {"every": OFFSET_INDEX_EVERY, "count": self.title_count, "offsets": self.offsets}
+        uploads = {
+            "json": self.json_upload.complete,
+            "json_gzip": self.gzip_upload.complete,
+            "tsv": self.tsv_upload.complete,
+            "offsets": lambda: upload_to_s3(json.dumps(offsets), f"{self.version_prefix}offsets.json", "json")
+        }
+        if self.parquet_writer is not None:
+            uploads["parquet"] = self.parquet_upload.complete
+            uploads["hashes"] = self.hashes_upload.complete
+        if self.has_diff:
+            uploads["diff"] = self.diff_upload.complete
+        run_concurrently(*uploads.values())
+
+        files = {"json": "data.json", "json_gzip": "data.json.gz", "tsv": "raw.tsv", "parquet": "data.parquet", "diff": "diff.json"}
+        return {
+            name: f"s3://{S3_BUCKET}/{self.version_prefix}{file_name}"
+            for name, file_name in files.items() if name in uploads
+        }
+
+    def abort(self):
+        """ Discards the uploads of the version """
+        self.json_upload.abort()
+        self.gzip_upload.abort()
+        self.tsv_upload.abort()
+        self.parquet_upload.abort()
+        self.hashes_upload.abort()
+        self.diff_upload.abort()
+        self._close_previous()
+
+
+def ingest_package(stream, package_name, additional_identifiers, host_url, update_index=True, package_id=None):
+    """
+    Runs the whole upload pipeline for one TSV: streams it into a new version,
+    deduplicates it against existing versions, and writes metadata.json, the
+    title index and (unless update_index is False) the package list entry.
+    - stream: readable binary stream of the TSV
+    - host_url: base URL used for packageContentAsJson
+    - package_id: package to add a version to (created if it does not exist yet);
+      a new package ID is generated without one
+
+    Returns the response body, the HTTP status and the package metadata
+    (None when the upload was rejected).
+    """
+    # Generate or use provided package ID
+    package_id = package_id or generate_package_id()
+
+    # Check if package exists and get the latest version; the delimiter listing
+    # returns one entry per version rather than every version file
+    version_numbers, previous_metadata = run_concurrently(
+        lambda: list_version_numbers(package_id),
+        lambda: get_package_metadata(package_id)
+    )
+    versions, date_created = package_versions(package_id, previous_metadata, version_numbers)
+    latest_version = max(versions, default=None)
+
+    # Reserve the next version number; versions claimed by concurrent uploads are skipped
+    claimed = claim_version(package_id, max(version_numbers, default=0) + 1)
+    # Stream the TSV into the new version, converting and validating it on the way
+    ingest = TsvIngest(stream, package_id, claimed, latest_version)
+    try:
+        return _ingest_version(
+            ingest, package_id, package_name, additional_identifiers, host_url, update_index,
+            claimed, latest_version, previous_metadata, versions, date_created
+        )
+    except BaseException:
+        # Whatever failed, no multipart upload of the version is left open
+        ingest.abort()
+        raise
+    finally:
+        release_version(package_id, claimed)
+
+
+def _ingest_version(ingest, package_id, package_name, additional_identifiers, host_url, update_index,
+                    version, latest_version, previous_metadata, versions, date_created):
+    """ ingest_package once a version number has been claimed """
+    try:
+        ingest.run()
+    except IngestError as e:
+        ingest.abort()
+        return {"error": str(e)}, 400, None
+
+    is_valid, validation_errors, validation_warnings = format_validation_result(ingest.errors, ingest.warnings)
+    if not is_valid:
+        ingest.abort()
+        return {"error": "Validation failed", "errors": json.loads(validation_errors), "warnings": json.loads(validation_warnings)}, 400, None
+
+    # An unchanged file keeps the latest version instead of creating a new one,
+    # a file matching an older version is recorded as a revert to it
+    checksums = version_checksums(package_id, previous_metadata, latest_version) if latest_version else {}
+    matching_version = checksums.get(ingest.checksum)
+    print(f"New checksum: {ingest.checksum}, Matching version: {matching_version}")
+    if latest_version and matching_version == latest_version:
+        version = latest_version
+
+    # Upload files
+    if version == latest_version:
+        ingest.abort()
+        version_data = {}
+        # Reloading an unchanged file under the same name and identifiers is a no-op,
+        # so metadata.json and the package list keep their revision and ETags
+        current = metadata_cache.get(f"packages/{package_id}/metadata.json", max_age=0)[0]
+        unchanged = (version, package_name, additional_identifiers or [], f"{host_url}package/{package_id}")
+        if current and tuple(
+            current.get(field) for field in ("latest", "name", "additional_identifiers", "packageContentAsJson")
+        ) == unchanged:
+            return _upload_response(package_id, version, None, validation_warnings), 200, current
+    else:
+        version_data = ingest.commit()
+        version_data["stats"] = ingest.stats
+        if matching_version:
+            version_data["revertOf"] = matching_version
+        update_title_index(package_id, version, ingest.issns)
+    # Record the raw.tsv digest so later uploads can be deduplicated without downloads
+    version_data["checksum"] = ingest.checksum
+
+    # Use head_object to get the version's LastModified timestamp
+    last_updated = storage.head(f"packages/{package_id}/versions/{version}/raw.tsv")["LastModified"].isoformat()
+
+    # This upload's view of the package, merged into metadata.json as stored when it is written
+    metadata = {
+        "identifier": package_id,
+        "name": package_name,
+        "latest": version,
+        "dateCreated": date_created or last_updated,
+        "lastUpdated": last_updated,
+        "titleCount": ingest.title_count,
+        "versions": {**versions, version: {**versions.get(version, {}), **version_data}},
+        "additional_identifiers": additional_identifiers or [],
+        "packageContentAsJson" : f"{host_url}package/{package_id}"
+    }
+
+    def merge_metadata(current):
+        """
+        Adds this version to metadata.json as it is now: versions recorded by
+        concurrent uploads are kept, and the package-level fields are this
+        upload's only if its version is still the latest.
+        """
+        merged_versions = {int(number): data for number, data in (current or {}).get("versions", {}).items()}
+        for number, data in metadata["versions"].items():
+            merged_versions.setdefault(number, data)
+        merged_versions[version] = {**merged_versions.get(version, {}), **version_data}
+        latest = max(merged_versions)
+        merged = {**metadata} if latest == version or not current else {**current}
+        merged["latest"] = latest
+        # Keyed as they read back from JSON, since the cache keeps the value as written
+        merged["versions"] = {str(number): data for number, data in sorted(merged_versions.items())}
+        merged["dateCreated"] = min(filter(None, [metadata["dateCreated"], (current or {}).get("dateCreated")]))
+        merged["revision"] = (current or {}).get("revision", 0) + 1
+        return merged
+
+    stored = update_json(f"packages/{package_id}/metadata.json", merge_metadata)
+    if update_index:
+        update_package_list(stored, append=True)
+    # Logged once metadata.json is in place, so consumers of the change feed can read it
+    if version != latest_version:
+        record_upload(metadata, latest_version, matching_version if matching_version != version else None)
+
+    revert_of = matching_version if matching_version and matching_version != version else None
+    return _upload_response(package_id, version, revert_of, validation_warnings), 200, stored
+
+
+def _upload_response(package_id, version, revert_of, validation_warnings):
+    response = {"message": "Package uploaded successfully", "package_id": package_id, "version": version}
+    if revert_of:
+        response["revert_of"] = revert_of
+    if validation_warnings:
+        response["message"] = "Package uploaded with warnings"
+        response["warnings"] = json.loads(validation_warnings)
+    return response
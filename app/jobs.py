@@ -0,0 +1,347 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from app.config import JOB_BACKEND, JOB_DB_PATH, JOB_WORKERS, JOB_POLL_INTERVAL, JOB_LEASE, JOB_RETENTION
+from app.services import storage
+
+# Raw uploads waiting for a worker are staged under this prefix
+JOB_UPLOAD_PREFIX = "jobs/"
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = "queued", "running", "succeeded", "failed"
+
+
+def new_job(kind, payload, job_id=None):
+    """ Builds a queued job record """
+    return {
+        "id": job_id or str(uuid.uuid4()),
+        "kind": kind,
+        "status": QUEUED,
+        "payload": payload,
+        "result": None,
+        "error": None,
+        "created": time.time(),
+        "started": None,
+        "finished": None
+    }
+
+
+class MemoryJobStore:
+    """
+    In-process job queue; jobs are lost when the process exits, and finished
+    jobs are forgotten JOB_RETENTION seconds after they finished
+    """
+
+    persistent = False
+
+    def __init__(self):
+        self.jobs = {}
+        self.queue = deque()
+        self.lock = threading.Lock()
+
+    def submit(self, job):
+        with self.lock:
+            self._prune()
+            self.jobs[job["id"]] = dict(job)
+            self.queue.append(job["id"])
+
+    def _prune(self):
+        expired = time.time() - JOB_RETENTION
+        for job_id in [job_id for job_id, job in self.jobs.items() if job["finished"] and job["finished"] < expired]:
+            del self.jobs[job_id]
+
+    def claim(self):
+        """ Marks the oldest queued job as running and returns it, or None when the queue is empty """
+        with self.lock:
+            while self.queue:
+                job = self.jobs.get(self.queue.popleft())
+                if job and job["status"] == QUEUED:
+                    job.update(status=RUNNING, started=time.time())
+                    return dict(job)
+        return None
+
+    def renew(self, job_ids):
+        """ Jobs live and die with this process, so there is no lease to extend """
+
+    def reset_after_fork(self):
+        self.lock = threading.Lock()
+
+    def update(self, job_id, **fields):
+        with self.lock:
+            self.jobs[job_id].update(fields)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+
+class SqliteJobStore:
+    """
+    Job queue persisted in a local SQLite database, so queued jobs survive a
+    restart and can be shared by several worker processes on the same host.
+    A claimed job is leased to the claiming store for JOB_LEASE seconds and
+    the lease is renewed while the job runs; a running job whose lease has
+    expired belonged to a process that died and is claimed again.
+    """
+
+    persistent = True
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        db = self._connect()
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, kind TEXT, status TEXT, payload TEXT, result TEXT, error TEXT, "
+            "created REAL, started REAL, finished REAL, owner TEXT, lease_expires REAL)"
+        )
+        # Databases created before jobs were leased
+        columns = {row["name"] for row in db.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in (("owner", "TEXT"), ("lease_expires", "REAL")):
+            if column not in columns:
+                db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+
+    def reset_after_fork(self):
+        """ A forked child opens its own connections and leases jobs under its own name """
+        self.local = threading.local()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def _connect(self):
+        """ One connection per thread; sqlite3 connections cannot be shared between threads """
+        if not hasattr(self.local, "db"):
+            self.local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self.local.db.row_factory = sqlite3.Row
+            self.local.db.execute("PRAGMA journal_mode=WAL")
+        return self.local.db
+
+    @staticmethod
+    def _to_job(row):
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def submit(self, job):
+        self._connect().execute(
+            "INSERT INTO jobs (id, kind, status, payload, created) VALUES (?, ?, ?, ?, ?)",
+            (job["id"], job["kind"], job["status"], json.dumps(job["payload"]), job["created"])
+        )
+
+    def claim(self):
+        """ Leases the oldest queued job, or running job whose lease has expired, to this store """
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            started = time.time()
+            row = db.execute(
+                "SELECT * FROM jobs WHERE status = ? OR (status = ? AND (lease_expires IS NULL OR lease_expires < ?)) "
+                "ORDER BY created LIMIT 1",
+                (QUEUED, RUNNING, started)
+            ).fetchone()
+            if row:
+                if row["status"] == RUNNING:
+                    print(f"Job {row['id']} was left running by {row['owner']}, claiming it again")
+                db.execute(
+                    "UPDATE jobs SET status = ?, started = ?, owner = ?, lease_expires = ? WHERE id = ?",
+                    (RUNNING, started, self.owner, started + JOB_LEASE, row["id"])
+                )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        if not row:
+            return None
+        return {**self._to_job(row), "status": RUNNING, "started": started, "owner": self.owner}
+
+    def renew(self, job_ids):
+        """ Extends the leases of jobs this store is running """
+        if not job_ids:
+            return
+        self._connect().execute(
+            f"UPDATE jobs SET lease_expires = ? WHERE status = ? AND owner = ? AND id IN ({', '.join('?' * len(job_ids))})",
+            (time.time() + JOB_LEASE, RUNNING, self.owner, *job_ids)
+        )
+
+    def update(self, job_id, **fields):
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"])
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        self._connect().execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_job(row) if row else None
+
+
+def create_job_store():
+    """ Selects the job store configured by JOB_BACKEND (memory or sqlite) """
+    if JOB_BACKEND == "memory":
+        return MemoryJobStore()
+    if JOB_BACKEND == "sqlite":
+        return SqliteJobStore(JOB_DB_PATH)
+    raise ValueError(f"Unknown JOB_BACKEND: {JOB_BACKEND}")
+
+
+class JobWorkers:
+    """
+    Background threads that claim jobs from a store and run the handler
+    registered for their kind. Threads start with the first submitted job, or
+    with the app for a persistent store (see start_persistent), and poll the
+    store every JOB_POLL_INTERVAL seconds so that jobs queued by other
+    processes sharing a persistent store are picked up too. While jobs run, a
+    heartbeat thread renews their leases every third of JOB_LEASE.
+    - handlers: {kind: function(payload) -> (result, succeeded)}
+    """
+
+    def __init__(self, store, handlers, workers):
+        self.store = store
+        self.handlers = handlers
+        self.workers = workers
+        self.wakeup = threading.Condition()
+        self.threads = []
+        self.heartbeat = None
+        self.running = set()
+
+    def submit(self, kind, payload, job_id=None):
+        job = new_job(kind, payload, job_id)
+        self.store.submit(job)
+        self.start()
+        with self.wakeup:
+            self.wakeup.notify()
+        return job
+
+    def start(self):
+        with self.wakeup:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work, name=f"job-worker-{len(self.threads)}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            if self.heartbeat is None:
+                self.heartbeat = threading.Thread(target=self._renew_leases, name="job-heartbeat", daemon=True)
+                self.heartbeat.start()
+
+    def start_persistent(self):
+        """
+        Starts the threads right away when the store is persistent, so jobs
+        left queued by a restart, or leased by a process that died, are run
+        without waiting for the next submission
+        """
+        if self.store.persistent:
+            self.start()
+
+    def reset_after_fork(self):
+        """
+        A forked child has none of the parent's threads; they are started
+        again at once for a persistent store, otherwise on the next submit
+        """
+        self.wakeup = threading.Condition()
+        self.threads = []
+        self.heartbeat = None
+        self.running = set()
+        self.store.reset_after_fork()
+        self.start_persistent()
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(JOB_LEASE / 3)
+            with self.wakeup:
+                job_ids = list(self.running)
+            try:
+                self.store.renew(job_ids)
+            except Exception as e:
+                print(f"Renewing job leases failed: {e}")
+
+    def _work(self):
+        while True:
+            try:
+                job = self.store.claim()
+                if job is not None:
+                    self.run(job)
+                    continue
+            except Exception as e:
+                # A store error (sqlite "database is locked", say) must not end the thread
+                print(f"Job worker error: {e}")
+            with self.wakeup:
+                self.wakeup.wait(JOB_POLL_INTERVAL)
+
+    def run(self, job):
+        with self.wakeup:
+            self.running.add(job["id"])
+        try:
+            result, succeeded = self.handlers[job["kind"]](job["payload"])
+            self.store.update(job["id"], status=SUCCEEDED if succeeded else FAILED, result=result, finished=time.time())
+        except Exception as e:
+            print(f"Job {job['id']} failed: {e}")
+            self.store.update(job["id"], status=FAILED, error=str(e), finished=time.time())
+        finally:
+            with self.wakeup:
+                self.running.discard(job["id"])
+
+
+def stage_upload(job_id, stream):
+    """ Stores the raw upload for a worker to ingest; returns its key """
+    s3_key = f"{JOB_UPLOAD_PREFIX}{job_id}/upload.tsv"
+    storage.upload_fileobj(stream, s3_key)
+    return s3_key
+
+
+def run_upload_job(payload):
+    """ Ingests a staged upload with the regular upload pipeline, then removes the staged copy """
+    from app.ingest import ingest_package
+
+    body = storage.get(payload["s3_key"])["Body"]
+    try:
+        response, status, metadata = ingest_package(
+            body, payload["package_name"], payload["additional_identifiers"], payload["host_url"],
+            package_id=payload.get("package_id")
+        )
+    finally:
+        body.close()
+    storage.delete([payload["s3_key"]])
+    return {**response, "status_code": status}, status == 200
+
+
+job_workers = JobWorkers(create_job_store(), {"upload": run_upload_job}, JOB_WORKERS)
+os.register_at_fork(after_in_child=job_workers.reset_after_fork)
+
+
+def submit_upload(stream, package_name, additional_identifiers, host_url, package_id=None):
+    """ Stages an upload and queues it for ingestion; returns the job record """
+    job_id = str(uuid.uuid4())
+    return job_workers.submit("upload", {
+        "s3_key": stage_upload(job_id, stream),
+        "package_name": package_name,
+        "additional_identifiers": additional_identifiers,
+        "host_url": host_url,
+        "package_id": package_id
+    }, job_id)
+
+
+def job_status(job_id):
+    """
+    Public view of a job: its status, timings and, once finished, the
+    package ID and version or the validation errors of the upload.
+    """
+    job = job_workers.store.get(job_id)
+    if not job:
+        return None
+    status = {
+        "job_id": job["id"],
+        "status": job["status"],
+        "package_name": job["payload"].get("package_name"),
+        "created": job["created"],
+        "started": job["started"],
+        "finished": job["finished"]
+    }
+    if job["result"]:
+        status.update(job["result"])
+    if job["error"]:
+        status["error"] = job["error"]
+    return status
@@ -0,0 +1,270 @@
+import contextlib
+import contextvars
+import functools
+import json
+import threading
+import time
+from app.config import METRICS_ENABLED, SLOW_REQUEST_MS
+
+# Spans and storage calls are only recorded when something consumes them
+ENABLED = METRICS_ENABLED or SLOW_REQUEST_MS > 0
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _labels(names, values):
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+def _braces(label_text):
+    return f"{{{label_text}}}" if label_text else ""
+
+
+class Counter:
+    """ Monotonic counter with a fixed set of label names """
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_braces(_labels(self.label_names, labels))} {value}")
+        return lines
+
+
+class Histogram:
+    """ Cumulative histogram with a fixed set of label names, rendered the way Prometheus expects """
+
+    def __init__(self, name, help_text, label_names=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            counts, total = self.values.get(labels, (None, 0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.values[labels] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                label_text = _labels(self.label_names, labels)
+                separator = "," if label_text else ""
+                cumulative = 0
+                for bound, count in zip((*self.buckets, "+Inf"), counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{label_text}{separator}le="{bound}"}} {cumulative}')
+                lines.append(f"{self.name}_sum{_braces(label_text)} {total}")
+                lines.append(f"{self.name}_count{_braces(label_text)} {cumulative}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram("microkb_request_seconds", "Time to handle a request", ("method", "route", "status"))
+REQUEST_STORAGE_CALLS = Histogram(
+    "microkb_request_storage_calls", "Storage calls made while handling a request", ("route",), COUNT_BUCKETS
+)
+SPAN_SECONDS = Histogram("microkb_span_seconds", "Time spent in a stage of request handling or ingest", ("span",))
+STORAGE_CALLS = Counter("microkb_storage_calls_total", "Calls to the storage backend", ("operation",))
+ROWS = Counter("microkb_rows_total", "Rows processed", ("stage",))
+BYTES = Counter("microkb_bytes_total", "Bytes processed", ("stage",))
+
+METRICS = (REQUEST_SECONDS, REQUEST_STORAGE_CALLS, SPAN_SECONDS, STORAGE_CALLS, ROWS, BYTES)
+
+
+class RequestTrace:
+    """ Span totals and storage call count of one request, shared by the threads working on it """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = {}
+        self.storage_calls = 0
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            count, total = self.spans.get(name, (0, 0))
+            self.spans[name] = (count + 1, total + seconds)
+
+    def count_storage_call(self):
+        with self.lock:
+            self.storage_calls += 1
+
+    def breakdown(self):
+        with self.lock:
+            return {
+                name: {"count": count, "total_ms": round(total * 1000, 3)}
+                for name, (count, total) in sorted(self.spans.items(), key=lambda item: -item[1][1])
+            }
+
+
+_trace = contextvars.ContextVar("microkb_request_trace", default=None)
+
+
+def _observe(name, seconds):
+    SPAN_SECONDS.observe(seconds, (name,))
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        _observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+def span(name):
+    """ Times a block: with span("parse"): ... """
+    return _Span(name) if ENABLED else _NO_SPAN
+
+
+def timed(name):
+    """ Decorator timing every call of a function as a span """
+    def decorate(function):
+        if not ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def record(stage, rows=0, size=0):
+    """ Counts rows and bytes processed by a stage """
+    if ENABLED:
+        if rows:
+            ROWS.inc(rows, (stage,))
+        if size:
+            BYTES.inc(size, (stage,))
+
+
+def propagate(call):
+    """ Binds call to the current request trace so it is kept when call runs on a pool thread """
+    if not ENABLED:
+        return call
+    return functools.partial(contextvars.copy_context().run, call)
+
+
+def start_request():
+    if ENABLED:
+        _trace.set(RequestTrace())
+
+
+def finish_request(method, route, status, path):
+    """ Records the current request's duration and storage calls and logs it when slow """
+    trace = _trace.get()
+    if trace is None:
+        return
+    _trace.set(None)
+    seconds = time.perf_counter() - trace.start
+    REQUEST_SECONDS.observe(seconds, (method, route, status))
+    REQUEST_STORAGE_CALLS.observe(trace.storage_calls, (route,))
+    if SLOW_REQUEST_MS and seconds * 1000 >= SLOW_REQUEST_MS:
+        print(json.dumps({
+            "slow_request": f"{method} {path}",
+            "status": status,
+            "duration_ms": round(seconds * 1000, 3),
+            "storage_calls": trace.storage_calls,
+            "spans": trace.breakdown()
+        }))
+
+
+class InstrumentedStorage:
+    """ Storage backend wrapper that times and counts every call, and each page of a listing """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        attribute = getattr(self.backend, name)
+        # url and presigned_url are computed locally, they make no call
+        if not callable(attribute) or name in ("url", "presigned_url"):
+            return attribute
+
+        @functools.wraps(attribute)
+        def call(*args, **kwargs):
+            if name == "list":
+                return self._pages(attribute(*args, **kwargs))
+            self._count(name)
+            with span(f"storage.{name}"):
+                return attribute(*args, **kwargs)
+        return call
+
+    def _pages(self, pages):
+        while True:
+            start = time.perf_counter()
+            page = next(pages, None)
+            if page is None:
+                return
+            _observe("storage.list", time.perf_counter() - start)
+            self._count("list")
+            yield page
+
+    @staticmethod
+    def _count(name):
+        STORAGE_CALLS.inc(1, (name,))
+        trace = _trace.get()
+        if trace is not None:
+            trace.count_storage_call()
+
+
+def instrument_storage(backend):
+    return InstrumentedStorage(backend) if ENABLED else backend
+
+
+def render(cache_stats=None):
+    """ Returns every metric in the Prometheus text exposition format """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    if cache_stats:
+        for counter in ("hits", "revalidations", "misses"):
+            name = f"microkb_metadata_cache_{counter}_total"
+            lines += [f"# TYPE {name} counter", f"{name} {cache_stats[counter]}"]
+        lookups = cache_stats["hits"] + cache_stats["revalidations"] + cache_stats["misses"]
+        lines += [
+            "# TYPE microkb_metadata_cache_entries gauge",
+            f"microkb_metadata_cache_entries {cache_stats['entries']}",
+            "# HELP microkb_metadata_cache_hit_ratio Share of lookups answered without reading the object",
+            "# TYPE microkb_metadata_cache_hit_ratio gauge",
+            f"microkb_metadata_cache_hit_ratio {(cache_stats['hits'] + cache_stats['revalidations']) / lookups if lookups else 0}"
+        ]
+    return "\n".join(lines) + "\n"
@@ -1,40 +1,119 @@
+import io
+import gzip
 import math
 import json
-import hashlib
-import pandas as pd
-from flask import Blueprint, request, jsonify
-from app.services import generate_package_id, upload_to_s3, update_package_list, s3_client
-from app.validations import validate_json
-from app.config import S3_BUCKET, AWS_REGION, ADDITIONAL_IDENTIFIERS_ALLOW
+import re
+import tarfile
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+from datetime import datetime
+from flask import Blueprint, Response, request, jsonify, url_for, redirect
+from werkzeug.http import is_resource_modified
+from app.services import (
+    update_package_list, update_package_list_entries, get_package_list_with_etag, rebuild_package_list,
+    get_package_metadata, get_package_metadata_with_etag, get_catalogue_stats_with_etag, combine_etags,
+    package_envelope, stream_package_json, read_titles, remove_from_title_index, lookup_title,
+    compose_diff, read_title_page, metadata_cache, presigned_urls, list_objects, delete_keys, storage
+)
+from app.validations import normalize_issn
+from app.jobs import submit_upload, job_status
+from app.changes import append_change, read_changes, is_cursor, DELETED
+from app.stats import with_rates
+from app.export import iter_packages, ndjson_chunks, tar_chunks, gzip_chunks
+from app.metrics import propagate, render
+from app.storage import NotFound
+from app.config import (
+    AWS_REGION, ADDITIONAL_IDENTIFIERS_ALLOW, BATCH_WORKERS, BATCH_SPOOL_SIZE, ASYNC_UPLOADS,
+    JSON_GZIP_LEVEL, GZIP_MIN_SIZE, STREAM_CHUNK_SIZE, METRICS_ENABLED, CHANGE_FEED_MAX_LIMIT
+)
 
 routes = Blueprint("routes", __name__)
 
-import hashlib
-
-def calculate_checksum(file_obj):
-    """ Computes the MD5 hash of a file object """
-    md5_hash = hashlib.md5()
-    file_obj.seek(0)  # Ensure we start reading from the beginning
-
-    # Read file in chunks to avoid memory issues with large files
-    while chunk := file_obj.read(8192):  
-        md5_hash.update(chunk)
-
-    file_obj.seek(0)  # Reset pointer for further operations
-    return md5_hash.hexdigest()
-
-def calculate_checksum_from_body(body):
-    """ Calculate the MD5 checksum from a stream body """
-    md5 = hashlib.md5()
-    body_content = body.read()
-    md5.update(body_content)
-    return md5.hexdigest()
-
+# Client-supplied package IDs become part of storage keys
+PACKAGE_ID_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]{0,127}$")
 
 def allowed_file(filename):
     """Check if file type is allowed."""
     return "." in filename and filename.rsplit(".", 1)[1].lower() in {"tsv", "csv"}
 
+def parse_additional_identifiers(additional_identifiers):
+    """
+    Validates the additional_identifiers form field.
+    Returns the parsed list and None, or None and an error message.
+    """
+    if not additional_identifiers:
+        return None, None
+    try:
+        print(additional_identifiers)
+        additional_identifiers = json.loads(additional_identifiers)
+        if not isinstance(additional_identifiers, list):
+            raise ValueError("Invalid additional_identifiers format")
+        for identifier in additional_identifiers:
+            if identifier["type"] in ADDITIONAL_IDENTIFIERS_ALLOW:
+                return None, f"Identifier type {identifier['type']} is not valid"
+            if not isinstance(identifier["identifier"], int) or identifier["identifier"] >= 10000:
+                return None, "Identifier must be an integer less than 10000"
+    except (ValueError, KeyError, TypeError) as e:
+        return None, f"Invalid additional_identifiers: {e}"
+    return additional_identifiers, None
+
+def parse_package_id(package_id):
+    """
+    Validates the optional package_id form field, which adds a version to that
+    package instead of creating a new one (or creates it under that ID).
+    Returns the package ID, None for a new package, and an error message or None.
+    """
+    if not package_id:
+        return None, None
+    if not PACKAGE_ID_PATTERN.match(package_id):
+        return None, "Invalid package_id: letters, digits, '.', '_' and '-' only, at most 128 characters"
+    return package_id, None
+
+def last_modified_of(metadata):
+    """ Returns a package's lastUpdated timestamp as a datetime, or None """
+    try:
+        return datetime.fromisoformat(metadata["lastUpdated"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def accepts_gzip():
+    return request.accept_encodings["gzip"] > 0
+
+def not_modified(etag, last_modified=None):
+    """
+    Returns a 304 response when the client's copy (If-None-Match, or
+    If-Modified-Since without it) is still current, otherwise None.
+    Lets routes answer revalidations before reading anything large from S3.
+    - etag: unquoted ETag of the uncompressed representation; the gzip
+      variant's ETag (see json_response) is accepted too
+    """
+    for candidate in (etag, f"{etag}-gzip"):
+        if not is_resource_modified(request.environ, etag=candidate, last_modified=last_modified):
+            response = Response(status=304)
+            response.set_etag(candidate)
+            response.last_modified = last_modified
+            response.vary.add("Accept-Encoding")
+            return response
+    return None
+
+def json_response(body, etag, last_modified=None):
+    """
+    Returns body as JSON with a strong ETag and Last-Modified, gzip-compressed
+    when the client accepts it and the body is at least GZIP_MIN_SIZE bytes,
+    or a 304 when the client's copy is still current.
+    - etag: unquoted ETag of the uncompressed representation
+    """
+    response = jsonify(body)
+    if accepts_gzip() and response.content_length >= GZIP_MIN_SIZE:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=JSON_GZIP_LEVEL, mtime=0))
+        response.content_encoding = "gzip"
+        etag = f"{etag}-gzip"
+    response.vary.add("Accept-Encoding")
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response.make_conditional(request)
+
 @routes.route("/upload", methods=["POST"])
 def upload_package():
     """ Handles TSV ingestion, converts to JSON, and updates package index """
@@ -56,138 +135,193 @@ def upload_package():
     if not package_name:
         return jsonify({"error": "Package name required"}), 400
 
-    # Generate or use provided package ID
-    package_id = generate_package_id()
-
-    # Validate additional_identifiers
-    if additional_identifiers:
+    additional_identifiers, error = parse_additional_identifiers(additional_identifiers)
+    if error:
+        return jsonify({"error": error}), 400
+    package_id, error = parse_package_id(request.form.get("package_id"))
+    if error:
+        return jsonify({"error": error}), 400
+
+    # In async mode the raw file is staged and ingested by a background worker
+    # (ASYNC_UPLOADS sets the default, an "async" parameter overrides it per request)
+    asynchronous = request.args.get("async", request.form.get("async"))
+    run_async = asynchronous.lower() in ("1", "true") if asynchronous is not None else ASYNC_UPLOADS
+    if run_async:
+        job = submit_upload(file.stream, package_name, additional_identifiers, request.host_url, package_id)
+        response = jsonify({"message": "Package queued for ingestion", "job_id": job["id"], "status": job["status"]})
+        response.headers["Location"] = f"/jobs/{job['id']}"
+        return response, 202
+
+    # The ingest pipeline (and with it pandas and pyarrow) is imported by the first upload
+    from app.ingest import ingest_package
+    response, status, metadata = ingest_package(
+        file.stream, package_name, additional_identifiers, request.host_url, package_id=package_id
+    )
+    return jsonify(response), status
+
+@routes.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """ Reports an upload job's status and, once finished, its version number or validation errors """
+    status = job_status(job_id)
+    if not status:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(status), 200
+
+def read_batch_archive(archive):
+    """
+    Reads a zip or tar archive holding TSV files and a manifest.json of
+    [{"file": ..., "package_name": ..., "additional_identifiers": [...], "package_id": ...}].
+    Raises ValueError (or the archive's own error) if the archive or its
+    manifest cannot be read at all. Returns a generator that yields
+    (filename, package_name, additional_identifiers, package_id, stream, error)
+    per manifest entry, each file copied to a spooled temporary file only when
+    it is reached, so the archive is read sequentially while packages are
+    processed in parallel. An entry that cannot be read yields its error
+    instead of a stream.
+    """
+    if zipfile.is_zipfile(archive):
+        archive.seek(0)
+        bundle = zipfile.ZipFile(archive)
+        names = set(bundle.namelist())
+        open_member = lambda name: bundle.open(name) if name in names else None
+    else:
+        archive.seek(0)
+        bundle = tarfile.open(fileobj=archive, mode="r:*")
+        open_member = lambda name: bundle.extractfile(name) if name in bundle.getnames() else None
+
+    manifest = open_member("manifest.json")
+    if manifest is None:
+        raise ValueError("Archive has no manifest.json")
+    entries = json.load(manifest)
+    if not isinstance(entries, list):
+        raise ValueError("manifest.json must be a list of entries")
+
+    def read_entry(entry):
+        if not isinstance(entry, dict) or not isinstance(entry.get("file"), str):
+            return None, None, None, None, None, "Manifest entry needs a \"file\""
+        filename, package_name, package_id = entry["file"], entry.get("package_name"), entry.get("package_id")
         try:
-            print(additional_identifiers)
-            additional_identifiers = json.loads(additional_identifiers)
-            if not isinstance(additional_identifiers, list):
-                raise ValueError("Invalid additional_identifiers format")
-            for identifier in additional_identifiers:
-                if identifier["type"] in ADDITIONAL_IDENTIFIERS_ALLOW:
-                    return jsonify({"error": f"Identifier type {identifier['type']} is not valid"}), 400
-                if not isinstance(identifier["identifier"], int) or identifier["identifier"] >= 10000:
-                    return jsonify({"error": "Identifier must be an integer less than 10000"}), 400
-        except (ValueError, KeyError, TypeError) as e:
-            return jsonify({"error": f"Invalid additional_identifiers: {e}"}), 400
-
-    # Read TSV and convert to JSON
+            identifiers = entry.get("additional_identifiers")
+            identifiers = json.dumps(identifiers) if identifiers else None
+            member = open_member(filename)
+            if member is None:
+                return filename, package_name, identifiers, package_id, None, "File not found in archive"
+            spooled = tempfile.SpooledTemporaryFile(max_size=BATCH_SPOOL_SIZE)
+            while chunk := member.read(io.DEFAULT_BUFFER_SIZE):
+                spooled.write(chunk)
+        except (ValueError, TypeError, OSError, EOFError, zipfile.BadZipFile, tarfile.TarError) as e:
+            return filename, package_name, None, package_id, None, f"Invalid archive entry: {e}"
+        spooled.seek(0)
+        return filename, package_name, identifiers, package_id, spooled, None
+
+    return (read_entry(entry) for entry in entries)
+
+def ingest_batch_item(filename, package_name, additional_identifiers, package_id, stream, error, host_url):
+    """ Validates and ingests one package of a batch; returns its result entry """
+    result = {"file": filename, "package_name": package_name}
+    if error:
+        return {**result, "status": 400, "error": error}, None
     try:
-        df = pd.read_csv(file, sep="\t")
-    except Exception as e:
-        return jsonify({"error": f"Error reading TSV: {e}"}), 400
-    try:
-        json_data = df.to_json(orient="records")
+        if not allowed_file(filename):
+            return {**result, "status": 400, "error": "Invalid file type"}, None
+        if stream.read(1) == b'':
+            return {**result, "status": 400, "error": "Empty file provided"}, None
+        stream.seek(0)
+        if not package_name:
+            return {**result, "status": 400, "error": "Package name required"}, None
+
+        additional_identifiers, error = parse_additional_identifiers(additional_identifiers)
+        if error:
+            return {**result, "status": 400, "error": error}, None
+        package_id, error = parse_package_id(package_id)
+        if error:
+            return {**result, "status": 400, "error": error}, None
+
+        from app.ingest import ingest_package
+        response, status, metadata = ingest_package(
+            stream, package_name, additional_identifiers, host_url, update_index=False, package_id=package_id
+        )
+        return {**result, "status": status, **response}, metadata
     except Exception as e:
-        return jsonify({"error": f"Error converting to JSON: {e}"}), 400
-
-    # Validate JSON data
-    is_valid, validation_errors, validation_warnings = validate_json(json.loads(json_data))
-    print(is_valid, validation_errors, validation_warnings)
-    if not is_valid:
-        return jsonify({"error": "Validation failed", "errors": json.loads(validation_errors), "warnings": json.loads(validation_warnings)}), 400
-
-    # Calculate title count using pandas
-    title_count = len(df)
+        # One package failing in storage must not lose the rest of the batch
+        print(f"Batch upload of {filename} failed: {e}")
+        return {**result, "status": 500, "error": str(e)}, None
+    finally:
+        # Frees a spooled archive member as soon as its package is done
+        stream.close()
+
+@routes.route("/upload/batch", methods=["POST"])
+def upload_batch():
+    """
+    Ingests many packages in one request, BATCH_WORKERS at a time.
+    Accepts either repeated file / package_name / additional_identifiers /
+    package_id form fields (matched by position) or a zip/tar "archive" with a manifest.json.
+    Archive members are read one by one as workers become free, so at most
+    BATCH_WORKERS of them are held at once.
+    The package list index is updated once for the whole batch.
+    """
+    if "archive" in request.files:
+        try:
+            items = read_batch_archive(request.files["archive"].stream)
+        except (ValueError, KeyError, TypeError, zipfile.BadZipFile, tarfile.TarError) as e:
+            return jsonify({"error": f"Invalid archive: {e}"}), 400
+    else:
+        files = request.files.getlist("file")
+        if not files:
+            return jsonify({"error": "No file provided"}), 400
+        package_names = request.form.getlist("package_name")
+        identifiers = request.form.getlist("additional_identifiers")
+        package_ids = request.form.getlist("package_id")
+        items = [
+            (
+                file.filename,
+                package_names[i] if i < len(package_names) else None,
+                identifiers[i] if i < len(identifiers) else None,
+                package_ids[i] if i < len(package_ids) else None,
+                file.stream,
+                None
+            )
+            for i, file in enumerate(files)
+        ]
+
+    host_url = request.host_url
+    outcomes = {}
+    in_flight = {}
+
+    def collect(return_when):
+        done, _ = wait(in_flight, return_when=return_when)
+        for future in done:
+            outcomes[in_flight.pop(future)] = future.result()
 
-    # Calculate checksum of the new file
-    new_checksum = calculate_checksum(file)
-    
-    # Check if package exists and get the latest version
-    version = 1
-    date_created = None
-    last_updated = None
     try:
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET, Prefix=f"packages/{package_id}/versions/")
-        print(response)
-        if "Contents" in response:
-            for obj in response["Contents"]:
-                print(obj["Key"].split("/")[3])
-            latest_version = max(int(obj["Key"].split("/")[3]) for obj in response["Contents"])
-            latest_metadata_key = f"packages/{package_id}/versions/{latest_version}/raw.tsv"
-            latest_metadata_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=latest_metadata_key)
-            latest_checksum = calculate_checksum_from_body(latest_metadata_obj["Body"])
-            
-            print(f"New checksum: {new_checksum}, Latest checksum: {latest_checksum}")
-            if new_checksum != latest_checksum:
-                version = latest_version + 1
-            else:
-                version = latest_version
-            # Find the earliest timestamp for date_created
-            first_version_obj = min(response["Contents"], key=lambda x: x["LastModified"])
-            date_created = first_version_obj["LastModified"].isoformat()
-    except s3_client.exceptions.NoSuchKey:
-        pass
-
-    # Define S3 paths
-    metadata_s3_key = f"packages/{package_id}/metadata.json"
-    json_s3_key = f"packages/{package_id}/versions/{version}/data.json"
-    tsv_s3_key = f"packages/{package_id}/versions/{version}/raw.tsv"
-
-    # Upload files
-    json_url = upload_to_s3(json_data, json_s3_key, 'json')
-    file.seek(0)  # Reset file pointer
-    tsv_url = upload_to_s3(file, tsv_s3_key, 'tsv')
-
-    # If first upload, Find the earliest timestamp for date_created
-    if not date_created:
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET, Prefix=f"packages/{package_id}/versions/")
-        if "Contents" in response and response["Contents"]:
-            first_version_obj = min(response["Contents"], key=lambda x: x["LastModified"])
-            date_created = first_version_obj["LastModified"].isoformat()
-
-    # Use head_object to get the latest version's LastModified timestamp
-    latest_version_key = f"packages/{package_id}/versions/{version}/raw.tsv"
-    latest_version_obj = s3_client.head_object(Bucket=S3_BUCKET, Key=latest_version_key)
-    last_updated = latest_version_obj["LastModified"].isoformat()
-
-    # Package metadata
-    metadata = {
-        "identifier": package_id,
-        "name": package_name,
-        "latest": version,
-        "dateCreated": date_created,
-        "lastUpdated": last_updated,
-        "titleCount": title_count,
-        "versions": {},
-        "additional_identifiers": [],
-        "packageContentAsJson" : f"{request.host_url}package/{package_id}"
-    }
-
-    if additional_identifiers:
-        metadata["additional_identifiers"] = additional_identifiers
-
-     # List all versions and update metadata
-    response = s3_client.list_objects_v2(Bucket=S3_BUCKET, Prefix=f"packages/{package_id}/versions/")
-    if "Contents" in response:
-        for obj in response["Contents"]:
-            version_number = int(obj["Key"].split("/")[3])
-            if obj["Key"].endswith("data.json"):
-                json_url = f"s3://{S3_BUCKET}/{obj['Key']}"
-            elif obj["Key"].endswith("raw.tsv"):
-                tsv_url = f"s3://{S3_BUCKET}/{obj['Key']}"
-                metadata["versions"][version_number] = {"json": json_url, "tsv": tsv_url}
-
-    # Upload metadata
-    upload_to_s3(json.dumps(metadata).encode("utf-8"), metadata_s3_key, 'json')
-
-    update_package_list()
-
-    if validation_warnings:
-        return jsonify({"message": "Package uploaded with warnings", "package_id": package_id, "version": version, "warnings": json.loads(validation_warnings)}), 200
-    return jsonify({"message": "Package uploaded successfully", "package_id": package_id, "version": version}), 200
+        with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+            # The next item is only read once a worker is free for it
+            for index, item in enumerate(items):
+                if len(in_flight) >= BATCH_WORKERS:
+                    collect(FIRST_COMPLETED)
+                in_flight[pool.submit(propagate(ingest_batch_item), *item, host_url)] = index
+            collect(ALL_COMPLETED)
+    finally:
+        # Packages already ingested are listed even if the batch was cut short
+        for future, index in in_flight.items():
+            if not future.cancelled() and future.exception() is None:
+                outcomes[index] = future.result()
+        update_package_list_entries([metadata for result, metadata in outcomes.values() if metadata])
+    outcomes = [outcomes[index] for index in range(len(outcomes))]
+
+    results = [result for result, metadata in outcomes]
+
+    succeeded = sum(1 for result in results if result["status"] == 200)
+    return jsonify({"succeeded": succeeded, "failed": len(results) - succeeded, "results": results}), 200
 
 @routes.route("/packages", methods=["GET"])
 def list_packages():
     """ Returns the package list from S3 with pagination """
-    try:
-        obj = s3_client.get_object(Bucket=S3_BUCKET, Key="package_list.json")
-        package_list = json.loads(obj["Body"].read().decode("utf-8")).get("packages", [])
-    except s3_client.exceptions.NoSuchKey:
-        package_list = []
+    package_list, etag = get_package_list_with_etag()
+    # Revalidations are answered before the list is serialized and compressed
+    cached = not_modified(etag)
+    if cached:
+        return cached
 
     # Check if the 'all' query parameter is set to 'true'
     all_packages = request.args.get("all", "false").lower() == "true"
@@ -200,7 +334,7 @@ def list_packages():
             "total": len(package_list),
             "packages": package_list
         }
-        return jsonify(response), 200
+        return json_response(response, etag)
 
     # Get pagination parameters
     page = int(request.args.get("page", 1))
@@ -224,15 +358,23 @@ def list_packages():
     if page > math.ceil(len(package_list) / per_page):
          return jsonify({"error": "Page not found"}), 404
 
-    return jsonify(response), 200
+    return json_response(response, etag)
+
+@routes.route("/packages/rebuild", methods=["POST"])
+def rebuild_packages():
+    """ Rebuilds the package list index from every package's metadata (repair only) """
+    package_count = rebuild_package_list()
+    return jsonify({"success": "Package list rebuilt", "total": package_count}), 200
 
 @routes.route("/package/<package_id>", methods=["GET"])
 def get_package(package_id):
     """ Returns metadata for a given package combined with the package JSON from the data.json file """
     try:
         # Fetch metadata
-        metadata_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=f"packages/{package_id}/metadata.json")
-        metadata = json.loads(metadata_obj["Body"].read().decode("utf-8"))
+        metadata, metadata_etag = get_package_metadata_with_etag(package_id)
+        if metadata is None:
+            return jsonify({"error": "Package not found"}), 404
+        last_modified = last_modified_of(metadata)
 
         # Fetch package JSON from the latest version
         versions = metadata.get("versions", {})
@@ -240,126 +382,354 @@ def get_package(package_id):
             return jsonify({"error": "No versions found"}), 404
 
         latest_version = max(int(v) for v in versions.keys())
-        package_json_key = f"packages/{package_id}/versions/{latest_version}/data.json"
-        package_json_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=package_json_key)
-        package_json = json.loads(package_json_obj["Body"].read().decode("utf-8"))
-
-        # Combine metadata and package JSON
-        # combined_data = {
-        #     "metadata": metadata,
-        #     "title_list": package_json
-        # }
-        combined_data = {
-        "Packages": [
-                {
-                    **metadata,
-                    "TitleList": package_json
-                }
-            ]
-        }
 
-    except s3_client.exceptions.NoSuchKey:
+        # Return a single page of titles when offset or limit is given
+        if "offset" in request.args or "limit" in request.args:
+            offset = max(request.args.get("offset", 0, type=int), 0)
+            limit = min(max(request.args.get("limit", 100, type=int), 0), 1000)
+            cached = not_modified(combine_etags(metadata_etag), last_modified)
+            if cached:
+                return cached
+            titles = read_title_page(package_id, latest_version, offset, limit)
+            return json_response({
+                "offset": offset,
+                "limit": limit,
+                "total": metadata.get("titleCount"),
+                "Packages": [{**metadata, "TitleList": titles}]
+            }, combine_etags(metadata_etag), last_modified)
+
+        # Serve the title list gzip-compressed at ingest when the client accepts it;
+        # metadata.json changes with every new version, so its ETag identifies the response
+        use_gzip = "json_gzip" in versions.get(str(latest_version), {}) and accepts_gzip()
+        etag = combine_etags(metadata_etag)
+        cached = not_modified(etag, last_modified)
+        if cached:
+            return cached
+
+        package_json_key = f"packages/{package_id}/versions/{latest_version}/data.json" + (".gz" if use_gzip else "")
+        package_json_obj = storage.get(package_json_key)
+
+    except NotFound:
         return jsonify({"error": "Package not found"}), 404
 
-    return jsonify(combined_data), 200
+    # Combine metadata and package JSON, copying the stored title list through without parsing it
+    # (a gzip stream may consist of several members, so the envelope is compressed on its own)
+    prefix, suffix = package_envelope(metadata)
+    if use_gzip:
+        prefix = gzip.compress(prefix, compresslevel=JSON_GZIP_LEVEL, mtime=0)
+        suffix = gzip.compress(suffix, compresslevel=JSON_GZIP_LEVEL, mtime=0)
+    response = Response(
+        stream_package_json(prefix, package_json_obj["Body"], suffix),
+        status=200,
+        mimetype="application/json"
+    )
+    response.content_length = len(prefix) + package_json_obj["ContentLength"] + len(suffix)
+    if use_gzip:
+        response.content_encoding = "gzip"
+        etag = f"{etag}-gzip"
+    response.vary.add("Accept-Encoding")
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
+
+@routes.route("/package/<package_id>/titles", methods=["GET"])
+def query_titles(package_id):
+    """
+    Returns selected columns of a package's titles from its Parquet copy.
+    - columns: comma separated column names (all columns when omitted)
+    - version: version to read (latest when omitted)
+    Any other query parameter is an equality filter on the column of that name.
+    """
+    metadata, metadata_etag = get_package_metadata_with_etag(package_id)
+    if metadata is None:
+        return jsonify({"error": "Package not found"}), 404
+
+    versions = metadata.get("versions", {})
+    if not versions:
+        return jsonify({"error": "No versions found"}), 404
+
+    version = request.args.get("version", max(int(v) for v in versions.keys()), type=int)
+    version_data = versions.get(str(version))
+    if not version_data:
+        return jsonify({"error": "Version not found"}), 404
+    if "parquet" not in version_data:
+        return jsonify({"error": "No columnar data for this version"}), 404
+
+    columns = [column for column in request.args.get("columns", "").split(",") if column]
+    filters = {key: value for key, value in request.args.items() if key not in ("columns", "version")}
+
+    cached = not_modified(combine_etags(metadata_etag), last_modified_of(metadata))
+    if cached:
+        return cached
 
-@routes.route("/package/<package_id>/versions", methods=["GET"])
-def list_package_versions(package_id):
-    """ Lists all versions of a package """
     try:
-        obj = s3_client.get_object(Bucket=S3_BUCKET, Key=f"packages/{package_id}/metadata.json")
-        metadata = json.loads(obj["Body"].read().decode("utf-8"))
-        versions = metadata.get("versions", {})
+        titles = read_titles(package_id, version, columns, filters)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except NotFound:
+        return jsonify({"error": "Package not found"}), 404
 
-        if not versions:
-            return jsonify({"error": "No versions found"}), 404
+    return json_response(
+        {"package_id": package_id, "version": version, "total": len(titles), "titles": titles},
+        combine_etags(metadata_etag), last_modified_of(metadata)
+    )
 
-    except s3_client.exceptions.NoSuchKey:
+@routes.route("/package/<package_id>/diff", methods=["GET"])
+def get_package_diff(package_id):
+    """ Returns the rows added, changed and removed between two versions of a package """
+    metadata, metadata_etag = get_package_metadata_with_etag(package_id)
+    if metadata is None:
         return jsonify({"error": "Package not found"}), 404
 
-    return jsonify({"package_id": package_id, "versions": list(versions.keys())}), 200
+    versions = metadata.get("versions", {})
+    if not versions:
+        return jsonify({"error": "No versions found"}), 404
+
+    from_version = request.args.get("from", type=int)
+    to_version = request.args.get("to", max(int(v) for v in versions.keys()), type=int)
+    if from_version is None:
+        return jsonify({"error": "from version required"}), 400
+    if from_version > to_version:
+        return jsonify({"error": "from version must not be after to version"}), 400
+    if str(from_version) not in versions or str(to_version) not in versions:
+        return jsonify({"error": "Version not found"}), 404
+
+    cached = not_modified(combine_etags(metadata_etag), last_modified_of(metadata))
+    if cached:
+        return cached
+
+    diff = compose_diff(package_id, from_version, to_version)
+    if diff is None:
+        return jsonify({"error": "Diff not available for these versions"}), 404
+
+    return json_response({"package_id": package_id, **diff}, combine_etags(metadata_etag), last_modified_of(metadata))
+
+@routes.route("/package/<package_id>/versions", methods=["GET"])
+def list_package_versions(package_id):
+    """ Lists all versions of a package """
+    metadata, metadata_etag = get_package_metadata_with_etag(package_id)
+    if metadata is None:
+        return jsonify({"error": "Package not found"}), 404
+
+    versions = metadata.get("versions", {})
+    if not versions:
+        return jsonify({"error": "No versions found"}), 404
+
+    return json_response(
+        {"package_id": package_id, "versions": list(versions.keys())},
+        combine_etags(metadata_etag), last_modified_of(metadata)
+    )
 
 @routes.route("/package/<package_id>/version/<int:version>", methods=["GET"])
 def get_package_version(package_id, version):
     """ Returns a specific version's metadata """
-    try:
-        obj = s3_client.get_object(Bucket=S3_BUCKET, Key=f"packages/{package_id}/metadata.json")
-        metadata = json.loads(obj["Body"].read().decode("utf-8"))
-        version_data = metadata["versions"].get(str(version))
+    metadata, metadata_etag = get_package_metadata_with_etag(package_id)
+    if metadata is None:
+        return jsonify({"error": "Package not found"}), 404
+
+    version_data = metadata["versions"].get(str(version))
+    if not version_data:
+        return jsonify({"error": "Version not found"}), 404
 
-        if not version_data:
-            return jsonify({"error": "Version not found"}), 404
+    return json_response(version_data, combine_etags(metadata_etag), last_modified_of(metadata))
 
-    except s3_client.exceptions.NoSuchKey:
+@routes.route("/package/<package_id>/stats", methods=["GET"])
+def get_package_stats(package_id):
+    """ Returns the title statistics computed when a version (the latest by default) was ingested """
+    metadata, metadata_etag = get_package_metadata_with_etag(package_id)
+    if metadata is None:
         return jsonify({"error": "Package not found"}), 404
 
-    return jsonify(version_data), 200
+    version = request.args.get("version", metadata.get("latest"), type=int)
+    version_data = metadata.get("versions", {}).get(str(version))
+    if not version_data:
+        return jsonify({"error": "Version not found"}), 404
+    if "stats" not in version_data:
+        return jsonify({"error": "No statistics for this version, it was ingested before they were computed"}), 404
+
+    return json_response(
+        {"package_id": package_id, "version": version, "stats": with_rates(version_data["stats"])},
+        combine_etags(metadata_etag), last_modified_of(metadata)
+    )
+
+@routes.route("/stats", methods=["GET"])
+def get_catalogue_stats():
+    """ Returns title statistics of the latest version of every package, maintained as packages change """
+    stats, etag = get_catalogue_stats_with_etag()
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    return json_response(with_rates(stats), etag)
 
 @routes.route("/package/<package_id>/download", methods=["GET"])
 def download_tsv(package_id):
-    """ Generates a pre-signed URL to download a TSV file """
+    """
+    Returns a pre-signed URL to download a TSV file, or with ?redirect=true
+    redirects to it. The latest version comes from the cached metadata and
+    URLs are reused until shortly before they expire.
+    """
     version = request.args.get("version")
 
     try:
-        if version:
-            # Download specific version
-            tsv_key = f"packages/{package_id}/versions/{version}/raw.tsv"
-        else:
+        metadata = get_package_metadata(package_id)
+        if metadata is None:
+            return jsonify({"error": "Package not found"}), 404
+
+        if not version:
             # Download latest version
-            metadata_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=f"packages/{package_id}/metadata.json")
-            metadata = json.loads(metadata_obj["Body"].read().decode("utf-8"))
             versions = metadata.get("versions", {})
             if not versions:
                 return jsonify({"error": "No versions found"}), 404
-
-            latest_version = max(int(v) for v in versions.keys())
-            tsv_key = f"packages/{package_id}/versions/{latest_version}/raw.tsv"
+            version = max(int(v) for v in versions.keys())
+        tsv_key = f"packages/{package_id}/versions/{version}/raw.tsv"
 
         # Get the package name from metadata
         package_name = metadata.get("package_name", package_id)
 
-        # Generate pre-signed URL
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': S3_BUCKET, 'Key': tsv_key},
-            ExpiresIn=3600
-        )
+        # Pre-signed URL; backends that cannot presign are served through /raw
+        presigned_url = presigned_urls.get(tsv_key)
+        if presigned_url is None:
+            presigned_url = url_for("routes.download_raw_tsv", package_id=package_id, version=version, _external=True)
+
+        if request.args.get("redirect", "").lower() in ("1", "true"):
+            return redirect(presigned_url, 302)
 
         # Set the Content-Disposition header to specify the filename
         response = jsonify({"url": presigned_url, "package_name": package_name})
         # response.headers["Content-Disposition"] = f"attachment; filename={package_name}.tsv"
         return response
 
-    except s3_client.exceptions.NoSuchKey:
+    except NotFound:
         return jsonify({"error": "Package not found"}), 404
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@routes.route("/package/<package_id>/raw", methods=["GET"])
+def download_raw_tsv(package_id):
+    """ Streams a version's raw TSV (the latest when no version is given) from storage """
+    version = request.args.get("version", type=int)
+    if version is None:
+        metadata = get_package_metadata(package_id)
+        if not metadata or not metadata.get("versions"):
+            return jsonify({"error": "Package not found"}), 404
+        version = max(int(v) for v in metadata["versions"].keys())
+
+    try:
+        tsv_obj = storage.get(f"packages/{package_id}/versions/{version}/raw.tsv")
+    except NotFound:
+        return jsonify({"error": "Package not found"}), 404
+
+    response = Response(
+        tsv_obj["Body"].iter_chunks(STREAM_CHUNK_SIZE),
+        status=200,
+        mimetype="text/tab-separated-values"
+    )
+    response.call_on_close(tsv_obj["Body"].close)
+    response.content_length = tsv_obj["ContentLength"]
+    response.headers["Content-Disposition"] = f"attachment; filename={package_id}-{version}.tsv"
+    return response
+
 @routes.route("/package/<package_id>", methods=["DELETE"])
 def delete_package(package_id):
     """ Deletes a package and all its associated files from S3 """
     try:
         # List all objects in the package directory
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET, Prefix=f"packages/{package_id}/")
-        objects_to_delete = [{"Key": obj["Key"]} for obj in response.get("Contents", [])]
+        keys_to_delete = [obj["Key"] for obj in list_objects(f"packages/{package_id}/")]
 
-        if not objects_to_delete:
+        if not keys_to_delete:
             return jsonify({"error": "Package not found"}), 404
 
-        # Delete all objects in the package directory
-        s3_client.delete_objects(
-            Bucket=S3_BUCKET,
-            Delete={"Objects": objects_to_delete}
-        )
+        remove_from_title_index(package_id)
 
-        update_package_list()
+        # Delete all objects in the package directory, 1000 keys per request
+        delete_keys(keys_to_delete)
+
+        metadata_cache.invalidate(f"packages/{package_id}/")
+        presigned_urls.invalidate(f"packages/{package_id}/")
+        update_package_list(removed_id=package_id)
+        append_change(DELETED, package_id)
         
         return jsonify({"success": f"Package {package_id} deleted successfully"}), 200
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
+@routes.route("/titles", methods=["GET"])
+def find_titles():
+    """ Returns the packages (and versions) that contain an ISSN, from the title index """
+    issn = request.args.get("issn")
+    if not issn:
+        return jsonify({"error": "ISSN required"}), 400
+
+    normalized_issn = normalize_issn(issn)
+    if not normalized_issn:
+        return jsonify({"error": "Invalid ISSN"}), 400
+
+    return jsonify({"issn": normalized_issn, "packages": lookup_title(normalized_issn)}), 200
+
+@routes.route("/changes", methods=["GET"])
+def list_changes():
+    """
+    Change feed for incremental sync: package creations, new versions and
+    deletions after the `since` cursor, oldest first.
+    - since: cursor of the last event already seen (omit to read from the start)
+    - limit: events per response, at most CHANGE_FEED_MAX_LIMIT
+
+    Consumers pass `next` as `since` on their following request.
+    """
+    since = request.args.get("since")
+    if since and not is_cursor(since):
+        return jsonify({"error": "Invalid cursor"}), 400
+    limit = request.args.get("limit", 100, type=int)
+    if not 1 <= limit <= CHANGE_FEED_MAX_LIMIT:
+        return jsonify({"error": f"limit must be between 1 and {CHANGE_FEED_MAX_LIMIT}"}), 400
+
+    changes, more = read_changes(since, limit)
+    return jsonify({
+        "changes": changes,
+        "next": changes[-1]["cursor"] if changes else since,
+        "more": more
+    }), 200
+
+@routes.route("/export", methods=["GET"])
+def export_catalogue():
+    """
+    Streams every package's metadata and latest title list in one response.
+    - format: "ndjson" (default), one {"metadata": ..., "titles": [...]} line per
+      package, or "tar", with <package_id>/metadata.json and data.json members
+    - gzip: "true" to compress the whole stream
+
+    Title lists are fetched EXPORT_PREFETCH packages ahead of the one being
+    written, and memory use does not grow with the size of the catalogue.
+    """
+    export_format = request.args.get("format", "ndjson")
+    if export_format == "ndjson":
+        chunks, mimetype, filename = ndjson_chunks(iter_packages()), "application/x-ndjson", "catalogue.ndjson"
+    elif export_format == "tar":
+        chunks, mimetype, filename = tar_chunks(iter_packages()), "application/x-tar", "catalogue.tar"
+    else:
+        return jsonify({"error": "format must be ndjson or tar"}), 400
+
+    if request.args.get("gzip", "").lower() in ("1", "true"):
+        chunks, mimetype, filename = gzip_chunks(chunks), "application/gzip", f"{filename}.gz"
+
+    response = Response(chunks, status=200, mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
+@routes.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    """ Returns hit/miss counters of the in-process metadata cache """
+    return jsonify(metadata_cache.stats()), 200
+
+@routes.route("/metrics", methods=["GET"])
+def metrics():
+    """ Request, stage and storage metrics in the Prometheus text format; enabled by METRICS_ENABLED """
+    if not METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled"}), 404
+    return Response(render(metadata_cache.stats()), mimetype="text/plain; version=0.0.4")
+
 @routes.route("/packages/metadata/additional_identifiers", methods=["GET"])
 def list_additional_identifiers():
     return jsonify(ADDITIONAL_IDENTIFIERS_ALLOW)
\ No newline at end of file
@@ -1,23 +1,193 @@
-import boto3
+import hashlib
+import io
 import json
+import os
+import random
+import shutil
+import tempfile
+import threading
 import time
 import uuid
-import os
-import pandas as pd
-from app.config import S3_BUCKET, AWS_REGION, AWS_ACCESS_KEY, AWS_SECRET_KEY
-
-# Read optional MinIO/S3 local endpoint
-S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL", None)
-
-# Initialize S3 Client with optional MinIO support
-s3_client = boto3.client(
-    "s3",
-    endpoint_url=S3_ENDPOINT_URL,  # This makes it work with MinIO locally
-    region_name=AWS_REGION,
-    aws_access_key_id=AWS_ACCESS_KEY,
-    aws_secret_access_key=AWS_SECRET_KEY
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from app.utils import calculate_checksum_from_body
+from app.storage import create_storage, NotFound, NotModified, PreconditionFailed, StorageError
+from app.coordinator import WriteCoordinator
+from app.metrics import instrument_storage, propagate, span, timed
+from app.stats import package_list_stats, add_package_list_stats, empty_stats
+from app.config import (
+    S3_BUCKET, PACKAGE_LIST_SHARDS,
+    METADATA_CACHE_SIZE, METADATA_CACHE_TTL, MULTIPART_PART_SIZE, STREAM_CHUNK_SIZE,
+    ROW_KEY_COLUMNS, S3_IO_WORKERS, MULTIPART_MAX_IN_FLIGHT, WARM_UP_PACKAGES,
+    PRESIGNED_URL_EXPIRY, PRESIGNED_URL_MIN_REMAINING, PRESIGNED_URL_CACHE_SIZE,
+    CONDITIONAL_WRITE_ATTEMPTS, CONDITIONAL_WRITE_BACKOFF, VERSION_CLAIM_ATTEMPTS, INDEX_WRITE_DELAY, INDEX_WRITE_MAX_BATCH
 )
 
+# S3 bucket or local directory, as chosen by STORAGE_BACKEND
+storage = instrument_storage(create_storage())
+
+# Independent S3 requests run on s3_io_pool; multipart parts have their own
+# pool so that work waiting on parts can never starve them of workers
+s3_io_pool = ThreadPoolExecutor(max_workers=S3_IO_WORKERS, thread_name_prefix="s3-io")
+s3_part_pool = ThreadPoolExecutor(max_workers=S3_IO_WORKERS, thread_name_prefix="s3-part")
+
+# The package list index is split into shards keyed by package ID
+PACKAGE_LIST_PREFIX = "package_list/"
+# Written once the package list shards hold every package (see migrate_package_list)
+PACKAGE_LIST_MIGRATED_KEY = f"{PACKAGE_LIST_PREFIX}migrated.json"
+
+# delete_objects accepts at most this many keys per request
+DELETE_BATCH_SIZE = 1000
+
+# The cross-package title index has one object per normalized ISSN
+TITLE_INDEX_PREFIX = "title_index/issn/"
+# Written once the per-ISSN objects hold every package (see migrate_title_index)
+TITLE_INDEX_MIGRATED_KEY = "title_index/migrated.json"
+
+# Created with If-None-Match in a version's prefix to reserve its number
+VERSION_CLAIM_FILE = "claim.json"
+
+
+class MetadataCache:
+    """
+    Bounded LRU cache of parsed JSON objects (metadata.json, package list shards).
+    - Entries younger than ttl seconds are served without contacting S3
+    - Older entries are revalidated with a conditional GET on the stored ETag
+    - Missing objects are cached as None so absent shards are not refetched
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_json(self, s3_key):
+        """ Returns the parsed JSON object stored at s3_key, or None if it does not exist """
+        return self.get(s3_key)[0]
+
+    def get(self, s3_key, max_age=None):
+        """
+        Returns the parsed JSON object stored at s3_key and its S3 ETag, (None, None) if it does not exist.
+        - max_age: revalidate entries older than this many seconds instead of ttl (0 always revalidates)
+        """
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            entry = self._entries.get(s3_key)
+            if entry and time.monotonic() - entry["fetched"] < max_age:
+                self._entries.move_to_end(s3_key)
+                self.hits += 1
+                return entry["value"], entry["etag"]
+
+        try:
+            obj = storage.get(s3_key, if_none_match=entry["etag"] if entry else None)
+        except NotFound:
+            self._count("misses")
+            self.store(s3_key, None, None)
+            return None, None
+        except NotModified:
+            self._count("revalidations")
+            self.store(s3_key, entry["value"], entry["etag"])
+            return entry["value"], entry["etag"]
+
+        self._count("misses")
+        value = json.loads(obj["Body"].read().decode("utf-8"))
+        self.store(s3_key, value, obj.get("ETag"))
+        return value, obj.get("ETag")
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def store(self, s3_key, value, etag):
+        """ Records a freshly read or written object """
+        with self._lock:
+            self._entries[s3_key] = {"value": value, "etag": etag, "fetched": time.monotonic()}
+            self._entries.move_to_end(s3_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, prefix=""):
+        """ Drops every cached entry whose key starts with prefix """
+        with self._lock:
+            for s3_key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[s3_key]
+
+    def stats(self):
+        """ Returns the cache counters used to size the cache """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "revalidations": self.revalidations,
+                "misses": self.misses
+            }
+
+
+metadata_cache = MetadataCache(METADATA_CACHE_SIZE, METADATA_CACHE_TTL)
+
+
+class PresignedUrlCache:
+    """
+    Bounded LRU cache of presigned GET URLs by object key. A URL is signed to
+    last expires_in seconds and handed out again until less than
+    min_remaining seconds of that are left, so a hot download link costs no
+    signing work, and every URL returned is still valid for min_remaining.
+    """
+
+    def __init__(self, max_entries, expires_in, min_remaining):
+        self.max_entries = max_entries
+        self.expires_in = expires_in
+        self.min_remaining = min_remaining
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, s3_key):
+        """ Returns a presigned URL for s3_key, or None if the storage backend cannot presign """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(s3_key)
+            if entry and entry["expires"] - now >= self.min_remaining:
+                self._entries.move_to_end(s3_key)
+                return entry["url"]
+
+        url = storage.presigned_url(s3_key, self.expires_in)
+        if url is None:
+            return None
+        with self._lock:
+            self._entries[s3_key] = {"url": url, "expires": now + self.expires_in}
+            self._entries.move_to_end(s3_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return url
+
+    def invalidate(self, prefix=""):
+        """ Drops every cached URL whose key starts with prefix """
+        with self._lock:
+            for s3_key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[s3_key]
+
+
+presigned_urls = PresignedUrlCache(PRESIGNED_URL_CACHE_SIZE, PRESIGNED_URL_EXPIRY, PRESIGNED_URL_MIN_REMAINING)
+
+def run_concurrently(*calls):
+    """
+    Runs independent S3 operations in parallel and returns their results in order.
+    - calls: zero-argument callables
+    The first exception raised by any call is re-raised once all have finished.
+    """
+    if len(calls) == 1:
+        return [calls[0]()]
+    futures = [s3_io_pool.submit(propagate(call)) for call in calls]
+    wait(futures)
+    return [future.result() for future in futures]
+
+
 def generate_package_id():
     return f"{uuid.uuid4()}"
 
@@ -49,55 +219,858 @@ def upload_to_s3(file_data, package_id, file_type):
         file_data = file_data.encode("utf-8")
 
     # Upload to S3
-    s3_client.put_object(
-        Bucket=S3_BUCKET,
-        Key=s3_key,
-        Body=file_data,
-        ContentType=content_types[file_type]
-    )
+    storage.put(s3_key, file_data, content_types[file_type])
+    metadata_cache.invalidate(s3_key)
 
     # Return file URL
-    return f"{S3_ENDPOINT_URL}/{S3_BUCKET}/{s3_key}" if S3_ENDPOINT_URL else f"https://{S3_BUCKET}.s3.{AWS_REGION}.amazonaws.com/{s3_key}"
+    return storage.url(s3_key)
+
+
+def list_pages(prefix, delimiter=None, start_after=None):
+    """ Yields every listing page under a prefix, following ContinuationToken """
+    return storage.list(prefix, delimiter, start_after)
+
+
+def list_objects(prefix, start_after=None):
+    """ Yields every object under a prefix, in key order (only those after start_after if given) """
+    for page in list_pages(prefix, start_after=start_after):
+        yield from page.get("Contents", [])
+
+
+def list_prefixes(prefix):
+    """ Yields the immediate "sub-directories" of a prefix, without enumerating the objects below them """
+    for page in list_pages(prefix, delimiter="/"):
+        for common_prefix in page.get("CommonPrefixes", []):
+            yield common_prefix["Prefix"]
+
+
+def list_version_numbers(package_id):
+    """ Returns the sorted version numbers of a package from one entry per version prefix """
+    versions_prefix = f"packages/{package_id}/versions/"
+    return sorted(int(prefix[len(versions_prefix):].rstrip("/")) for prefix in list_prefixes(versions_prefix))
+
+
+def claim_version(package_id, first):
+    """
+    Reserves the lowest free version number of a package from first upwards by
+    creating its claim object with If-None-Match, so two concurrent uploads of
+    the same package can never write the same version. Returns the number.
+    """
+    for version in range(first, first + VERSION_CLAIM_ATTEMPTS):
+        try:
+            storage.put(f"packages/{package_id}/versions/{version}/{VERSION_CLAIM_FILE}", b"{}", "application/json", if_none_match="*")
+            return version
+        except PreconditionFailed:
+            continue
+    raise StorageError(f"No free version of package {package_id} between {first} and {first + VERSION_CLAIM_ATTEMPTS - 1}")
+
+
+def release_version(package_id, version):
+    """ Drops a version's claim, once the version is recorded in metadata.json or the upload was abandoned """
+    storage.delete([f"packages/{package_id}/versions/{version}/{VERSION_CLAIM_FILE}"])
+
+
+VERSION_FILES = {"data.json": "json", "data.json.gz": "json_gzip", "raw.tsv": "tsv", "data.parquet": "parquet", "diff.json": "diff"}
+
+
+def package_versions(package_id, metadata, version_numbers):
+    """
+    Returns the versions entry of a package's metadata ({version: {json, tsv, ...}})
+    and its creation date. Versions already recorded in metadata.json are reused;
+    only versions missing from it (packages written before the metadata kept
+    every version) are listed object by object. A version that is still
+    claimed is being written by another upload and is left out.
+    """
+    recorded = metadata.get("versions", {}) if metadata else {}
+    versions = {
+        version_number: dict(recorded[str(version_number)])
+        for version_number in version_numbers if str(version_number) in recorded
+    }
+    date_created = metadata.get("dateCreated") if metadata else None
+
+    missing = [version_number for version_number in version_numbers if version_number not in versions]
+    listings = run_concurrently(*[
+        lambda version_number=version_number: list(list_objects(f"packages/{package_id}/versions/{version_number}/"))
+        for version_number in missing
+    ])
+    for objects in listings:
+        if any(obj["Key"].endswith(f"/{VERSION_CLAIM_FILE}") for obj in objects):
+            continue
+        for obj in objects:
+            version_number = int(obj["Key"].split("/")[3])
+            file_name = obj["Key"].split("/")[4]
+            if file_name in VERSION_FILES:
+                version_data = versions.setdefault(version_number, {})
+                version_data[VERSION_FILES[file_name]] = f"s3://{S3_BUCKET}/{obj['Key']}"
+            created = obj["LastModified"].isoformat()
+            if not date_created or created < date_created:
+                date_created = created
+
+    return dict(sorted(versions.items())), date_created
+
+
+def delete_keys(keys):
+    """
+    Deletes objects in batches of DELETE_BATCH_SIZE keys (the S3 maximum),
+    sending the batches concurrently. Returns the number of keys deleted;
+    raises StorageError if any key could not be deleted.
+    """
+    keys = list(keys)
+    batches = [keys[i:i + DELETE_BATCH_SIZE] for i in range(0, len(keys), DELETE_BATCH_SIZE)]
+    run_concurrently(*[lambda batch=batch: storage.delete(batch) for batch in batches])
+    return len(keys)
+
+
+class MultipartUpload:
+    """
+    Streams an object to S3 in parts of MULTIPART_PART_SIZE bytes.
+    Parts are sent in the background, at most MULTIPART_MAX_IN_FLIGHT at a
+    time, so producing the data overlaps with uploading it.
+    Objects smaller than one part never start a multipart upload and are
+    written with a single put_object on complete().
+    Nothing is visible in the bucket until complete() is called.
+    """
+
+    def __init__(self, s3_key, content_type):
+        self.s3_key = s3_key
+        self.content_type = content_type
+        self.upload_id = None
+        self.parts = []
+        self._pending = []
+        self._buffer = bytearray()
+
+    def write(self, data):
+        """ Buffers data and sends a part whenever a full part is available """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._buffer.extend(data)
+        if len(self._buffer) >= MULTIPART_PART_SIZE:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = storage.create_multipart_upload(self.s3_key, self.content_type)
+        while len(self._pending) >= MULTIPART_MAX_IN_FLIGHT:
+            self._pending.pop(0).result()
+
+        part_number = len(self.parts) + 1
+        part = {"PartNumber": part_number}
+        self.parts.append(part)
+        self._pending.append(s3_part_pool.submit(propagate(self._send_part), part, bytes(self._buffer)))
+        self._buffer.clear()
+
+    def _send_part(self, part, body):
+        part["ETag"] = storage.upload_part(self.s3_key, self.upload_id, part["PartNumber"], body)
+
+    def _wait_for_parts(self):
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def complete(self):
+        """ Makes the object visible in the bucket and returns its URL """
+        if self.upload_id is None:
+            storage.put(self.s3_key, bytes(self._buffer), self.content_type)
+        else:
+            if self._buffer:
+                self._upload_part()
+            self._wait_for_parts()
+            storage.complete_multipart_upload(self.s3_key, self.upload_id, self.parts)
+            # Completed, so a later abort() leaves the object alone
+            self.upload_id = None
+        self._buffer.clear()
+        metadata_cache.invalidate(self.s3_key)
+        return storage.url(self.s3_key)
+
+    def abort(self):
+        """ Discards everything written so far """
+        for future in self._pending:
+            future.cancel()
+        try:
+            self._wait_for_parts()
+        except Exception:
+            pass
+        if self.upload_id is not None:
+            storage.abort_multipart_upload(self.s3_key, self.upload_id)
+            self.upload_id = None
+        self.parts = []
+        self._buffer.clear()
+
+
+@timed("version_checksums")
+def version_checksums(package_id, metadata, latest_version):
+    """
+    Returns a map of raw.tsv MD5 digest to version number for a package.
+    Digests are recorded in metadata.json at upload time. For a latest version
+    written before that, the digest is taken from the ETag of its raw.tsv
+    (the MD5 of the content for single part uploads) and only hashed from the
+    object body when the ETag belongs to a multipart upload.
+    """
+    checksums = {}
+    versions = metadata.get("versions", {}) if metadata else {}
+    for version_number, version_data in sorted(versions.items(), key=lambda item: int(item[0])):
+        if version_data.get("checksum"):
+            checksums[version_data["checksum"]] = int(version_number)
+
+    if versions.get(str(latest_version), {}).get("checksum"):
+        return checksums
+
+    tsv_key = f"packages/{package_id}/versions/{latest_version}/raw.tsv"
+    etag = storage.head(tsv_key)["ETag"].strip('"')
+    if "-" in etag:
+        etag = calculate_checksum_from_body(storage.get(tsv_key)["Body"])
+    checksums[etag] = latest_version
+    return checksums
+
+
+def package_envelope(metadata):
+    """
+    Returns the bytes that go before and after a stored title list to form
+    {"Packages": [{...metadata..., "TitleList": <data.json>}]}
+    """
+    fields = json.dumps(metadata, sort_keys=True, separators=(",", ":"))[1:-1]
+    prefix = '{"Packages":[{' + fields + ("," if fields else "") + '"TitleList":'
+    return prefix.encode("utf-8"), b"}]}"
+
+
+def stream_package_json(prefix, body, suffix):
+    """ Yields a package response, copying the data.json body through in chunks """
+    yield prefix
+    try:
+        for chunk in body.iter_chunks(STREAM_CHUNK_SIZE):
+            yield chunk
+    finally:
+        body.close()
+    yield suffix
+
+
+class S3RangeReader(io.RawIOBase):
+    """ Seekable read-only view of a stored object that fetches only the byte ranges read """
+
+    def __init__(self, s3_key):
+        self.s3_key = s3_key
+        self.size = storage.head(s3_key)["ContentLength"]
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or not len(buffer):
+            return 0
+        end = min(self.position + len(buffer), self.size) - 1
+        obj = storage.get(self.s3_key, byte_range=(self.position, end))
+        data = obj["Body"].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+@timed("parquet_query")
+def read_titles(package_id, version, columns=None, filters=None):
+    """
+    Reads titles from the Parquet copy of a package version.
+    - columns: column names to return (all columns when empty)
+    - filters: {column: value} equality filters
+
+    Only the footer, the row groups whose statistics can match the filters and
+    the column chunks that are needed are fetched, using ranged GETs.
+    Raises ValueError for unknown columns.
+    """
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    filters = filters or {}
+    parquet_file = pq.ParquetFile(S3RangeReader(f"packages/{package_id}/versions/{version}/data.parquet"))
+    schema_columns = parquet_file.schema_arrow.names
+    columns = columns or schema_columns
+    for column in list(columns) + list(filters):
+        if column not in schema_columns:
+            raise ValueError(f"Unknown column: {column}")
+
+    titles = []
+    read_columns = list(dict.fromkeys(list(columns) + list(filters)))
+    for row_group in range(parquet_file.num_row_groups):
+        # Skip row groups whose min/max statistics rule out a filter value
+        row_group_metadata = parquet_file.metadata.row_group(row_group)
+        skip = False
+        for column, value in filters.items():
+            statistics = row_group_metadata.column(schema_columns.index(column)).statistics
+            if statistics is not None and statistics.has_min_max:
+                if statistics.null_count == row_group_metadata.num_rows or not statistics.min <= value <= statistics.max:
+                    skip = True
+        if skip:
+            continue
+
+        table = parquet_file.read_row_group(row_group, columns=read_columns)
+        for column, value in filters.items():
+            table = table.filter(pc.equal(table[column], value))
+        titles.extend(table.select(list(columns)).to_pylist())
+    return titles
+
+
+def read_row_hashes(version_prefix):
+    """
+    Returns the per-row hash table stored with a version as a ParquetFile, or
+    None for versions without one. The object is spooled to a temporary file
+    so its columns and row groups can be read one at a time; close(force=True)
+    removes the file.
+    """
+    import pyarrow.parquet as pq
+
+    try:
+        obj = storage.get(f"{version_prefix}row_hashes.parquet")
+    except NotFound:
+        return None
+    spooled = tempfile.TemporaryFile()
+    try:
+        shutil.copyfileobj(obj["Body"], spooled)
+    finally:
+        obj["Body"].close()
+    spooled.seek(0)
+    return pq.ParquetFile(spooled)
+
+
+def _row_key_value(value):
+    """ Renders an identifier the way the text columns of the row hash table store it """
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return None if value is None else str(value)
+
+
+@timed("diff_compose")
+def compose_diff(package_id, from_version, to_version):
+    """
+    Composes the stored diff manifests of every version after from_version up
+    to to_version into one manifest, keyed on the title identifier columns.
+    A row changed back to what it was at from_version is left out; manifests
+    written before they carried row hashes cannot show that and report it as changed.
+    Returns None if a manifest in the range is missing.
+    """
+    # key: (change, row, hash of the row at from_version, hash of the row at to_version)
+    changes = {}
+    for version in range(from_version + 1, to_version + 1):
+        try:
+            obj = storage.get(f"packages/{package_id}/versions/{version}/diff.json")
+        except NotFound:
+            return None
+        diff = json.loads(obj["Body"].read().decode("utf-8"))
+        row_hashes = diff.get("row_hashes", {})
 
+        for change, rows in (("removed", diff["removed"]), ("changed", diff["changed"]), ("added", diff["added"])):
+            hashes = row_hashes.get(change) or [None] * len(rows)
+            for row, row_hash in zip(rows, hashes):
+                before, after = {"removed": (row_hash, None), "changed": row_hash or (None, None), "added": (None, row_hash)}[change]
+                key = tuple(_row_key_value(row.get(column)) for column in ROW_KEY_COLUMNS)
+                previous, _, original, _ = changes.get(key, (None, None, before, None))
+                if change == "removed" and previous == "added":
+                    changes.pop(key)
+                elif change == "added" and previous == "removed":
+                    changes[key] = ("changed", row, original, after)
+                elif change == "changed" and previous == "added":
+                    changes[key] = ("added", row, original, after)
+                else:
+                    changes[key] = (change, row, original, after)
 
-def update_package_list(new_metadata=None, append=False):
-    """ Reads existing package metadata from S3 and generates a new package list """
-    s3_key = "package_list.json"
+    diff = {"from": from_version, "to": to_version, "added": [], "changed": [], "removed": []}
+    for change, row, original, final in changes.values():
+        if change == "changed" and original is not None and original == final:
+            continue
+        if change == "removed":
+            row = {column: value for column, value in row.items() if column in ROW_KEY_COLUMNS}
+        diff[change].append(row)
+    return diff
+
+
+@timed("title_page")
+def read_title_page(package_id, version, offset, limit):
+    """
+    Returns titles offset to offset + limit of a package version.
+    The sidecar offsets.json locates the bytes of the page in data.json so only
+    that range is fetched and parsed. Versions without a sidecar are read whole.
+    """
+    version_prefix = f"packages/{package_id}/versions/{version}/"
+    index = metadata_cache.get_json(f"{version_prefix}offsets.json")
+    if index is None:
+        obj = storage.get(f"{version_prefix}data.json")
+        return json.loads(obj["Body"].read().decode("utf-8"))[offset:offset + limit]
+
+    if offset >= index["count"] or limit <= 0:
+        return []
+
+    every, offsets = index["every"], index["offsets"]
+    first_block = offset // every
+    last_block = min(-(-(offset + limit) // every), len(offsets) - 1)
+    obj = storage.get(f"{version_prefix}data.json", byte_range=(offsets[first_block], offsets[last_block] - 1))
+    titles = json.loads(b"[" + obj["Body"].read().rstrip(b",") + b"]")
+    start = offset - first_block * every
+    return titles[start:start + limit]
+
+
+def package_list_shard_key(package_id):
+    """ Returns the S3 key of the package list shard that holds a package """
+    shard = int(hashlib.md5(package_id.encode("utf-8")).hexdigest(), 16) % PACKAGE_LIST_SHARDS
+    return f"{PACKAGE_LIST_PREFIX}{shard:02x}.json"
+
+
+def get_package_metadata(package_id):
+    """ Returns the parsed metadata.json of a package, or None if it does not exist """
+    return metadata_cache.get_json(f"packages/{package_id}/metadata.json")
+
+
+def get_package_metadata_with_etag(package_id):
+    """ Returns the parsed metadata.json of a package and its ETag, (None, None) if it does not exist """
+    return metadata_cache.get(f"packages/{package_id}/metadata.json")
+
+
+def combine_etags(*parts):
+    """ Derives one strong ETag (unquoted) from the ETags of stored objects and other version markers """
+    return hashlib.md5("/".join(str(part).strip('"') for part in parts).encode("utf-8")).hexdigest()
+
+
+def read_package_list_shard(s3_key):
+    """ Reads the packages stored in a single package list shard """
+    shard = metadata_cache.get_json(s3_key)
+    return shard.get("packages", []) if shard else []
+
+
+def put_json(s3_key, value, if_match=None, if_none_match=None):
+    """ Saves a JSON object to S3 and keeps the cached copy in step; conditional like storage.put """
+    try:
+        response = storage.put(s3_key, json.dumps(value), "application/json", if_match=if_match, if_none_match=if_none_match)
+    except PreconditionFailed:
+        metadata_cache.invalidate(s3_key)
+        raise
+    metadata_cache.store(s3_key, value, response.get("ETag"))
+
+
+def update_json(s3_key, change):
+    """
+    Optimistic read-modify-write of a JSON object.
+    - change: function(current) returning the new value, or None to leave the
+      object as it is; current is None when the object does not exist and
+      must not be modified in place
+
+    The write is conditional on the object still having the ETag it was read
+    with (or still not existing). When another writer got there first the
+    object is read again and change reapplied, up to CONDITIONAL_WRITE_ATTEMPTS
+    times with jittered exponential backoff. Returns the value written, or the
+    current value when change returned None.
+    """
+    for attempt in range(CONDITIONAL_WRITE_ATTEMPTS):
+        current, etag = metadata_cache.get(s3_key, max_age=0)
+        value = change(current)
+        if value is None:
+            return current
+        try:
+            if current is None:
+                put_json(s3_key, value, if_none_match="*")
+            else:
+                put_json(s3_key, value, if_match=etag)
+            return value
+        except PreconditionFailed:
+            time.sleep(random.uniform(0, CONDITIONAL_WRITE_BACKOFF * 2 ** attempt))
+    raise StorageError(f"Gave up writing {s3_key} after {CONDITIONAL_WRITE_ATTEMPTS} conflicting writes")
+
+
+def package_list_shard(package_list):
+    """
+    A package list shard as stored, with the summed statistics of its packages
+    so catalogue statistics never have to visit every package
+    """
+    return {"packages": package_list, "stats": package_list_stats(package_list)}
+
+
+def write_package_list_shard(s3_key, package_list):
+    """ Saves a single package list shard back to S3 """
+    put_json(s3_key, package_list_shard(package_list))
+
+
+def get_package_list():
+    """ Reads every package list shard and returns the packages ordered by identifier """
+    return get_package_list_with_etag()[0]
+
+
+def get_package_list_with_etag():
+    """ Returns the package list and an ETag derived from the ETags of its shards """
+    migrate_package_list()
     package_list = []
+    etags = []
+    for shard in range(PACKAGE_LIST_SHARDS):
+        value, etag = metadata_cache.get(f"{PACKAGE_LIST_PREFIX}{shard:02x}.json")
+        package_list.extend(value.get("packages", []) if value else [])
+        etags.append(etag or "")
+    return sorted(package_list, key=lambda package: package.get("identifier", "")), combine_etags(*etags)
+
+
+def get_catalogue_stats_with_etag():
+    """
+    Returns the statistics of the whole catalogue, summed from the totals
+    kept in each package list shard, and an ETag derived from the shards.
+    """
+    migrate_package_list()
+    total = {"packages": 0, "packages_without_stats": 0, **empty_stats()}
+    etags = []
+    for shard in range(PACKAGE_LIST_SHARDS):
+        value, etag = metadata_cache.get(f"{PACKAGE_LIST_PREFIX}{shard:02x}.json")
+        if value:
+            # Shards written before statistics were kept are summed on the fly
+            add_package_list_stats(total, value.get("stats") or package_list_stats(value.get("packages", [])))
+        etags.append(etag or "")
+    return total, combine_etags(*etags)
 
-    if append:
+
+def warm_up(packages=WARM_UP_PACKAGES):
+    """
+    Prepares a fresh worker for its first requests. Reading the package list
+    shards concurrently opens storage connections and starts the I/O pool
+    threads while caching the list; the metadata of up to `packages` packages
+    is then cached too. Returns the number of packages whose metadata was read.
+    """
+    migrate_package_list()
+    migrate_title_index()
+    shards = run_concurrently(*[
+        lambda shard=shard: metadata_cache.get_json(f"{PACKAGE_LIST_PREFIX}{shard:02x}.json")
+        for shard in range(PACKAGE_LIST_SHARDS)
+    ])
+    package_ids = [package["identifier"] for shard in shards if shard for package in shard.get("packages", [])]
+    run_concurrently(*[
+        lambda package_id=package_id: get_package_metadata(package_id)
+        for package_id in package_ids[:packages]
+    ])
+    return min(len(package_ids), packages)
+
+
+def _reset_after_fork():
+    """
+    A forked child inherits the module state of its parent but none of its
+    threads: after warm-up in a parent that forks its workers (gunicorn
+    --preload) the I/O pools would wait forever on workers that do not exist.
+    The child gets new pools, index writers and locks, and opens its own
+    storage connections; cached metadata is kept, it is revalidated as usual.
+    """
+    global s3_io_pool, s3_part_pool, _package_list_migration_lock, _title_index_migration_lock
+    s3_io_pool = ThreadPoolExecutor(max_workers=S3_IO_WORKERS, thread_name_prefix="s3-io")
+    s3_part_pool = ThreadPoolExecutor(max_workers=S3_IO_WORKERS, thread_name_prefix="s3-part")
+    package_list_writer.reset_after_fork()
+    title_index_writer.reset_after_fork()
+    metadata_cache._lock = threading.Lock()
+    presigned_urls._lock = threading.Lock()
+    _title_index_migration_lock = threading.Lock()
+    getattr(storage, "backend", storage).reset_after_fork()
+    _package_list_migration_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+@timed("package_list_rebuild")
+def rebuild_package_list():
+    """
+    Rebuilds every package list shard from the metadata.json of each package.
+    This is a full O(N) rescan, intended for repair and migration only.
+
+    Returns the number of packages indexed.
+    """
+    shards = {f"{PACKAGE_LIST_PREFIX}{shard:02x}.json": [] for shard in range(PACKAGE_LIST_SHARDS)}
+    for metadata in read_all_package_metadata():
+        shards[package_list_shard_key(metadata["identifier"])].append(metadata)
+
+    # Empty shards are written too so that stale entries are cleared
+    for s3_key, package_list in shards.items():
+        write_package_list_shard(s3_key, package_list)
+    put_json(PACKAGE_LIST_MIGRATED_KEY, {"packages": sum(len(package_list) for package_list in shards.values())})
+
+    return sum(len(package_list) for package_list in shards.values())
+
+
+def read_all_package_metadata():
+    """ Returns the metadata.json of every package, from a delimiter listing and then the files in parallel """
+    def read_metadata(package_prefix):
+        package_id = package_prefix.split("/")[1]
         try:
-            obj = s3_client.get_object(Bucket=S3_BUCKET, Key=s3_key)
-            package_list = json.loads(obj["Body"].read().decode("utf-8")).get("packages", [])
-        except s3_client.exceptions.NoSuchKey:
-            package_list = []
-
-        if new_metadata:
-            package_list.append(new_metadata)
-
-    else:
-        # List all objects in the 'packages/' prefix
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET, Prefix="packages/")
-        for obj in response.get("Contents", []):
-            if obj["Key"].endswith("metadata.json"):
-                package_id = obj["Key"].split("/")[1]
-                try:
-                    metadata_obj = s3_client.get_object(Bucket=S3_BUCKET, Key=obj["Key"])
-                    metadata = json.loads(metadata_obj["Body"].read().decode("utf-8"))
-                    if isinstance(metadata, dict):
-                        package_list.append(metadata)
-                    else:
-                        print(f"Warning: Metadata for package {package_id} is not a dictionary.")
-                except s3_client.exceptions.NoSuchKey:
-                    continue
-
-    # Wrap the package list in the initial JSON structure
-    package_list_json = {"packages": package_list}
-
-    # Save the updated package list back to S3
-    s3_client.put_object(
-        Bucket=S3_BUCKET,
-        Key=s3_key,
-        Body=json.dumps(package_list_json),
-        ContentType="application/json"
-    )
\ No newline at end of file
+            metadata_obj = storage.get(f"{package_prefix}metadata.json")
+        except NotFound:
+            return package_id, None
+        return package_id, json.loads(metadata_obj["Body"].read().decode("utf-8"))
+
+    packages = []
+    futures = [s3_io_pool.submit(propagate(read_metadata), prefix) for prefix in list_prefixes("packages/")]
+    for package_id, metadata in (future.result() for future in futures):
+        if isinstance(metadata, dict):
+            packages.append({**metadata, "identifier": metadata.get("identifier", package_id)})
+        elif metadata is not None:
+            print(f"Warning: Metadata for package {package_id} is not a dictionary.")
+    return packages
+
+
+def update_package_list(new_metadata=None, append=False, removed_id=None):
+    """
+    Applies a change to the package list index.
+    - new_metadata: metadata of a package to insert or replace (with append=True)
+    - removed_id: identifier of a package to drop from the index
+
+    Only the shard holding the changed package is read and rewritten.
+    Without append or removed_id the whole index is rebuilt instead.
+    """
+    if not append and not removed_id:
+        rebuild_package_list()
+        return
+
+    update_package_list_entries([new_metadata] if new_metadata else [], [removed_id] if removed_id else [])
+
+
+def update_package_list_entries(new_metadata_list, removed_ids=()):
+    """
+    Applies many package list changes at once, such as those of a batch upload,
+    and returns once they are written. Changes are handed to package_list_writer,
+    so those made by concurrent requests are written together.
+    """
+    # The writes run on the writer's thread, outside the request's trace; the wait is timed here
+    with span("package_list_update_wait"):
+        package_list_writer.submit_all(
+            [("upsert", metadata) for metadata in new_metadata_list] + [("remove", package_id) for package_id in removed_ids]
+        )
+
+
+def _revision(metadata):
+    # Metadata written before revisions were kept counts as the oldest
+    return metadata.get("revision", 0) if metadata else 0
+
+
+@timed("package_list_update")
+def _apply_package_list_changes(changes):
+    """
+    Writes a batch of ("upsert", metadata) and ("remove", package_id) changes.
+    The changes to one package collapse into the last one, except that an
+    upsert never replaces metadata of a later revision. Each affected shard
+    is then updated once, conditionally, shards in parallel.
+    """
+    final = {}
+    for action, value in changes:
+        package_id = value["identifier"] if action == "upsert" else value
+        if action == "upsert" and final.get(package_id, (None, None))[0] == "upsert" and _revision(final[package_id][1]) > _revision(value):
+            continue
+        final[package_id] = (action, value)
+
+    shards = {}
+    for package_id, change in final.items():
+        shards.setdefault(package_list_shard_key(package_id), {})[package_id] = change
+
+    def change_shard(shard_changes, current):
+        packages = {package.get("identifier"): package for package in (current or {}).get("packages", [])}
+        changed = False
+        for package_id, (action, value) in shard_changes.items():
+            if action == "remove":
+                changed |= packages.pop(package_id, None) is not None
+            elif _revision(packages.get(package_id)) <= _revision(value) and packages.get(package_id) != value:
+                packages[package_id] = value
+                changed = True
+        # An unchanged shard is not rewritten, so its ETag stays valid for clients
+        return package_list_shard(list(packages.values())) if changed else None
+
+    run_concurrently(*[
+        lambda s3_key=s3_key, shard_changes=shard_changes: update_json(
+            s3_key, lambda current: change_shard(shard_changes, current)
+        )
+        for s3_key, shard_changes in shards.items()
+    ])
+
+
+package_list_writer = WriteCoordinator(_apply_package_list_changes, INDEX_WRITE_DELAY, INDEX_WRITE_MAX_BATCH, "package-list-writer")
+
+
+_package_list_migrated = threading.Event()
+_package_list_migration_lock = threading.Lock()
+
+
+def migrate_package_list():
+    """
+    Fills the package list shards from every package's metadata.json the first
+    time a deployment reads them, so a bucket whose catalogue was kept in the
+    single package_list.json is not served as empty. Entries go through
+    package_list_writer and never replace those of packages uploaded since.
+    Done once per bucket, as recorded by PACKAGE_LIST_MIGRATED_KEY, and
+    checked once per process.
+    """
+    if _package_list_migrated.is_set():
+        return
+    with _package_list_migration_lock:
+        if _package_list_migrated.is_set():
+            return
+        if metadata_cache.get_json(PACKAGE_LIST_MIGRATED_KEY) is None:
+            packages = read_all_package_metadata()
+            print(f"Migrating {len(packages)} packages into the package list shards")
+            update_package_list_entries(packages)
+            try:
+                put_json(PACKAGE_LIST_MIGRATED_KEY, {"packages": len(packages)}, if_none_match="*")
+            except PreconditionFailed:
+                pass
+        _package_list_migrated.set()
+
+
+def title_index_key(issn):
+    """ Returns the S3 key of the title index object of a normalized ISSN """
+    return f"{TITLE_INDEX_PREFIX}{issn}.json"
+
+
+def title_keys_key(package_id):
+    return f"packages/{package_id}/title_keys.json"
+
+
+@timed("title_index_update")
+def _apply_title_index_changes(changes):
+    """
+    Writes a batch of (package_id, version, removed, added) title index changes.
+    - version: the version the change indexes, None to drop the package's entries whatever their version
+    - removed: ISSNs that no longer point at the package
+    - added: ISSNs that now point at the package
+
+    Each ISSN a change names is brought in line with the package's
+    title_keys.json as it is now, so a change overtaken by a later version
+    neither adds ISSNs that version dropped nor removes ones it kept. Only the
+    objects of those ISSNs are read and written, conditionally and in parallel.
+    """
+    package_ids = sorted({package_id for package_id, version, removed, added in changes if version is not None})
+    manifests = dict(zip(package_ids, run_concurrently(*[
+        lambda package_id=package_id: metadata_cache.get(title_keys_key(package_id), max_age=0)[0]
+        for package_id in package_ids
+    ])))
+
+    # {s3_key: {package_id: whether the ISSN points at it}}
+    objects = {}
+    indexed = {package_id: set(manifest["issns"]) if manifest else set() for package_id, manifest in manifests.items()}
+    for package_id, version, removed, added in changes:
+        current = indexed[package_id] if version is not None else set()
+        for issn in set(removed) | set(added):
+            objects.setdefault(title_index_key(issn), {})[package_id] = issn in current
+
+    def change_object(members, current):
+        packages = set(current["packages"]) if current else set()
+        updated = {package_id for package_id, member in members.items() if member}
+        updated |= packages - {package_id for package_id, member in members.items() if not member}
+        return {"packages": sorted(updated)} if updated != packages else None
+
+    run_concurrently(*[
+        lambda s3_key=s3_key, members=members: update_json(
+            s3_key, lambda current: change_object(members, current)
+        )
+        for s3_key, members in objects.items()
+    ])
+
+
+title_index_writer = WriteCoordinator(_apply_title_index_changes, INDEX_WRITE_DELAY, INDEX_WRITE_MAX_BATCH, "title-index-writer")
+
+
+def update_title_index(package_id, version, issns):
+    """
+    Points the cross-package title index at a new version of a package.
+    The ISSNs indexed for each package are kept in packages/<id>/title_keys.json,
+    so only the objects of ISSNs the package gained or lost are written; a
+    manifest marked "partial" after a failed update has all of them written
+    again. Nothing is changed when a later version of the package has already
+    been indexed.
+    """
+    previous = {}
+
+    def change_manifest(current):
+        if current and current.get("version", 0) > version:
+            return None
+        previous["issns"] = current["issns"] if current else []
+        previous["partial"] = bool(current and current.get("partial"))
+        return {"version": version, "issns": sorted(issns)}
+
+    manifest = update_json(title_keys_key(package_id), change_manifest)
+    if manifest["version"] != version:
+        return
+
+    removed = set(previous["issns"]) - set(issns)
+    added = set(issns) if previous["partial"] else set(issns) - set(previous["issns"])
+    try:
+        with span("title_index_update_wait"):
+            title_index_writer.submit((package_id, version, removed, added)).result()
+    except Exception:
+        update_json(
+            title_keys_key(package_id),
+            lambda current: {**current, "partial": True} if current and current["version"] == version else None
+        )
+        raise
+
+
+def remove_from_title_index(package_id):
+    """ Drops every title index entry of a package; call before its objects are deleted """
+    # Read fresh: another process may have indexed a newer version within the cache TTL
+    previous = metadata_cache.get(title_keys_key(package_id), max_age=0)[0]
+    if previous:
+        with span("title_index_update_wait"):
+            title_index_writer.submit((package_id, None, previous["issns"], ())).result()
+
+
+_title_index_migrated = threading.Event()
+_title_index_migration_lock = threading.Lock()
+
+
+def migrate_title_index():
+    """
+    Fills the per-ISSN title index objects from every package's
+    title_keys.json the first time a deployment looks a title up, so a bucket
+    indexed in the earlier fixed set of hash shards keeps answering. Done once
+    per bucket, as recorded by TITLE_INDEX_MIGRATED_KEY, and checked once per
+    process.
+    """
+    if _title_index_migrated.is_set():
+        return
+    with _title_index_migration_lock:
+        if _title_index_migrated.is_set():
+            return
+        if metadata_cache.get_json(TITLE_INDEX_MIGRATED_KEY) is None:
+            package_ids = [prefix.split("/")[1] for prefix in list_prefixes("packages/")]
+            packages = 0
+            # A batch of manifests at a time, so the whole corpus is never held at once
+            for start in range(0, len(package_ids), INDEX_WRITE_MAX_BATCH):
+                batch = package_ids[start:start + INDEX_WRITE_MAX_BATCH]
+                manifests = run_concurrently(*[
+                    lambda package_id=package_id: metadata_cache.get(title_keys_key(package_id), max_age=0)[0]
+                    for package_id in batch
+                ])
+                title_index_writer.submit_all([
+                    (package_id, manifest["version"], (), manifest["issns"])
+                    for package_id, manifest in zip(batch, manifests) if manifest
+                ])
+                packages += sum(1 for manifest in manifests if manifest)
+            print(f"Migrated {packages} packages into the per-ISSN title index")
+            try:
+                put_json(TITLE_INDEX_MIGRATED_KEY, {"packages": packages}, if_none_match="*")
+            except PreconditionFailed:
+                pass
+        _title_index_migrated.set()
+
+
+def lookup_title(issn):
+    """
+    Returns the packages that contain a normalized ISSN, each with its latest
+    version: one read of the ISSN's object, then the (cached) metadata of
+    each package it names.
+    """
+    migrate_title_index()
+    index = metadata_cache.get_json(title_index_key(issn))
+    package_ids = index["packages"] if index else []
+    packages = run_concurrently(*[lambda package_id=package_id: get_package_metadata(package_id) for package_id in package_ids])
+    return [
+        {"package_id": package_id, "version": metadata["latest"]}
+        for package_id, metadata in zip(package_ids, packages) if metadata
+    ]
@@ -0,0 +1,106 @@
+from app.validations import ISSN_REGEX, issn_check_digits_match
+
+# Columns whose ISSN coverage and validity are counted
+STATS_ISSN_COLUMNS = ("print_identifier", "online_identifier")
+
+
+def empty_stats():
+    return {
+        "titles": 0,
+        "publication_type": {},
+        "identifiers": {
+            column: {"present": 0, "invalid": 0, "check_digit_mismatch": 0} for column in STATS_ISSN_COLUMNS
+        },
+        "any_identifier": 0
+    }
+
+
+def chunk_stats(chunk):
+    """
+    Counts of one parsed chunk of a title list: titles by publication_type,
+    and for each ISSN column the titles that have a value, values that are not
+    well formed ISSNs and well formed ISSNs whose check digit does not match.
+    """
+    stats = empty_stats()
+    stats["titles"] = len(chunk)
+    if "publication_type" in chunk.columns:
+        types = chunk["publication_type"].dropna().astype(str).str.strip()
+        stats["publication_type"] = {name: int(count) for name, count in types[types != ""].value_counts().items()}
+
+    any_present = None
+    for column in STATS_ISSN_COLUMNS:
+        if column not in chunk.columns:
+            continue
+        values = chunk[column]
+        present = values.notna() & (values.astype(str).str.strip() != "")
+        text = values[present].astype(str).str.strip()
+        well_formed = text.str.match(ISSN_REGEX)
+        matches = issn_check_digits_match(text[well_formed].tolist())
+        stats["identifiers"][column] = {
+            "present": int(present.sum()),
+            "invalid": int((~well_formed).sum()),
+            "check_digit_mismatch": int((~matches).sum())
+        }
+        any_present = present if any_present is None else any_present | present
+    stats["any_identifier"] = int(any_present.sum()) if any_present is not None else 0
+    return stats
+
+
+def add_stats(total, stats):
+    """ Adds the counts of stats into total in place; returns total """
+    total["titles"] += stats.get("titles", 0)
+    total["any_identifier"] += stats.get("any_identifier", 0)
+    for name, count in stats.get("publication_type", {}).items():
+        total["publication_type"][name] = total["publication_type"].get(name, 0) + count
+    for column, counts in stats.get("identifiers", {}).items():
+        column_total = total["identifiers"].setdefault(column, {"present": 0, "invalid": 0, "check_digit_mismatch": 0})
+        for counter, count in counts.items():
+            column_total[counter] = column_total.get(counter, 0) + count
+    return total
+
+
+def latest_stats(metadata):
+    """ Returns the statistics of a package's latest version, or None if it was ingested without them """
+    versions = metadata.get("versions", {})
+    # Keys are strings once metadata has been through JSON, integers while it is being built
+    version = versions.get(str(metadata.get("latest"))) or versions.get(metadata.get("latest")) or {}
+    return version.get("stats")
+
+
+def package_list_stats(package_list):
+    """ Sums the latest version statistics of packages, counting those that have none separately """
+    total = {"packages": 0, "packages_without_stats": 0, **empty_stats()}
+    for metadata in package_list:
+        stats = latest_stats(metadata)
+        if stats is None:
+            total["packages_without_stats"] += 1
+            continue
+        total["packages"] += 1
+        add_stats(total, stats)
+    return total
+
+
+def add_package_list_stats(total, stats):
+    """ Adds the totals of one package list shard, as package_list_stats returns them, into total """
+    total["packages"] += stats["packages"]
+    total["packages_without_stats"] += stats["packages_without_stats"]
+    return add_stats(total, stats)
+
+
+def with_rates(stats):
+    """ Returns a copy of stats with coverage and error rates added to each ISSN column """
+    titles = stats["titles"]
+    identifiers = {}
+    for column, counts in stats["identifiers"].items():
+        present = counts["present"]
+        identifiers[column] = {
+            **counts,
+            "coverage": round(present / titles, 4) if titles else 0,
+            "invalid_rate": round(counts["invalid"] / present, 4) if present else 0,
+            "check_digit_mismatch_rate": round(counts["check_digit_mismatch"] / present, 4) if present else 0
+        }
+    return {
+        **stats,
+        "identifiers": identifiers,
+        "any_identifier_coverage": round(stats["any_identifier"] / titles, 4) if titles else 0
+    }
@@ -0,0 +1,419 @@
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from datetime import datetime, timezone
+from app.config import (
+    S3_BUCKET, AWS_REGION, AWS_ACCESS_KEY, AWS_SECRET_KEY, S3_ENDPOINT_URL, S3_MAX_POOL_CONNECTIONS,
+    S3_MAX_ATTEMPTS, S3_CONNECT_TIMEOUT, S3_READ_TIMEOUT, STORAGE_BACKEND, LOCAL_STORAGE_PATH
+)
+
+
+class StorageError(Exception):
+    """ Raised when a storage operation fails """
+
+
+class NotFound(StorageError):
+    """ Raised when an object does not exist """
+
+
+class NotModified(StorageError):
+    """ Raised by a conditional get when the object still has the given ETag """
+
+
+class PreconditionFailed(StorageError):
+    """ Raised by a conditional put when the object no longer has the expected ETag, or already exists """
+
+
+class S3Storage:
+    """
+    Objects in an S3 (or MinIO) bucket.
+    Every method returns the fields of the boto3 response the rest of the
+    app uses ("Body", "ContentLength", "ETag", "LastModified", ...).
+    boto3 is imported and the client built on first use, so processes that
+    never reach S3 do not pay for either.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    import boto3
+                    from botocore.config import Config
+                    # S3_ENDPOINT_URL makes it work with MinIO locally
+                    self._client = boto3.client(
+                        "s3",
+                        endpoint_url=S3_ENDPOINT_URL,
+                        region_name=AWS_REGION,
+                        aws_access_key_id=AWS_ACCESS_KEY,
+                        aws_secret_access_key=AWS_SECRET_KEY,
+                        config=Config(
+                            max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                            retries={"max_attempts": S3_MAX_ATTEMPTS, "mode": "standard"},
+                            connect_timeout=S3_CONNECT_TIMEOUT,
+                            read_timeout=S3_READ_TIMEOUT
+                        )
+                    )
+        return self._client
+
+    def reset_after_fork(self):
+        """ Drops the client, whose pooled connections are shared with the parent process """
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    def get(self, key, byte_range=None, if_none_match=None):
+        """
+        Returns an object with a streaming "Body".
+        - byte_range: (first, last) byte positions, inclusive
+        - if_none_match: ETag; NotModified is raised if the object still has it
+        """
+        request = {"Bucket": self.bucket, "Key": key}
+        if byte_range:
+            request["Range"] = f"bytes={byte_range[0]}-{byte_range[1]}"
+        if if_none_match:
+            request["IfNoneMatch"] = if_none_match
+        try:
+            return self.client.get_object(**request)
+        except self.client.exceptions.NoSuchKey:
+            raise NotFound(key)
+        except self.client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("304", "NotModified"):
+                raise NotModified(key)
+            raise
+
+    def head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                raise NotFound(key)
+            raise
+
+    def put(self, key, body, content_type=None, if_match=None, if_none_match=None):
+        """
+        Stores an object; conditional when given one of:
+        - if_match: ETag the object must still have
+        - if_none_match: "*" to store only if the object does not exist yet
+        PreconditionFailed is raised when the condition does not hold.
+        """
+        request = {"Bucket": self.bucket, "Key": key, "Body": body}
+        if content_type:
+            request["ContentType"] = content_type
+        if if_match:
+            request["IfMatch"] = if_match
+        if if_none_match:
+            request["IfNoneMatch"] = if_none_match
+        try:
+            return self.client.put_object(**request)
+        except self.client.exceptions.ClientError as e:
+            code = e.response["Error"]["Code"]
+            # A concurrent conditional write of the same key is reported as a conflict,
+            # an If-Match on a key that was deleted as a missing key
+            if code in ("PreconditionFailed", "412", "ConditionalRequestConflict") or (if_match and code == "NoSuchKey"):
+                raise PreconditionFailed(key)
+            raise
+
+    def upload_fileobj(self, stream, key):
+        """ Stores a readable stream of unknown length """
+        self.client.upload_fileobj(stream, self.bucket, key)
+
+    def list(self, prefix, delimiter=None, start_after=None):
+        """
+        Yields pages of {"Contents": [...], "CommonPrefixes": [...]}, following ContinuationToken.
+        - start_after: only keys that sort after this one are listed
+        """
+        params = {"Bucket": self.bucket, "Prefix": prefix}
+        if delimiter:
+            params["Delimiter"] = delimiter
+        if start_after:
+            params["StartAfter"] = start_after
+        while True:
+            response = self.client.list_objects_v2(**params)
+            yield response
+            if not response.get("IsTruncated"):
+                return
+            params["ContinuationToken"] = response["NextContinuationToken"]
+
+    def delete(self, keys):
+        """ Deletes up to 1000 keys; raises StorageError if any could not be deleted """
+        response = self.client.delete_objects(
+            Bucket=self.bucket,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True}
+        )
+        errors = response.get("Errors", [])
+        if errors:
+            raise StorageError(f"Failed to delete {len(errors)} objects, first: {errors[0].get('Key')}: {errors[0].get('Message')}")
+
+    def create_multipart_upload(self, key, content_type):
+        return self.client.create_multipart_upload(Bucket=self.bucket, Key=key, ContentType=content_type)["UploadId"]
+
+    def upload_part(self, key, upload_id, part_number, data):
+        """ Uploads one part and returns its ETag """
+        return self.client.upload_part(
+            Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=data
+        )["ETag"]
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        """ - parts: [{"PartNumber": ..., "ETag": ...}] in order """
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+        )
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+
+    def url(self, key):
+        """ Returns the public URL of an object in the bucket """
+        return f"{S3_ENDPOINT_URL}/{self.bucket}/{key}" if S3_ENDPOINT_URL else f"https://{self.bucket}.s3.{AWS_REGION}.amazonaws.com/{key}"
+
+    def presigned_url(self, key, expires_in):
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": key},
+            ExpiresIn=expires_in
+        )
+
+
+class MappedBody:
+    """
+    Streaming body over a memory-mapped file, with the read/iter_chunks/close
+    interface of a botocore StreamingBody. Reads are served from the page
+    cache without a system call per chunk.
+    """
+
+    def __init__(self, mapped, start, end):
+        self.mapped = mapped
+        self.position = start
+        self.end = end
+
+    def read(self, size=-1):
+        end = self.end if size is None or size < 0 else min(self.end, self.position + size)
+        data = self.mapped[self.position:end] if self.mapped is not None else b""
+        self.position = end
+        return data
+
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+
+class LocalStorage:
+    """
+    Objects as files under a root directory, keys mapping to relative paths.
+    Writes go to a temporary file that is renamed into place, so readers
+    always see a complete object; reads are memory-mapped. ETags are derived
+    from the inode, modification time and size, so they change on every
+    write but are not MD5 digests of the content. Renames and conditional
+    puts hold a lock file, which makes them atomic across the processes
+    sharing the directory.
+    """
+
+    # Multipart uploads and temporary files live here, outside the key space
+    WORK_DIR = ".work"
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(os.path.join(self.root, self.WORK_DIR), exist_ok=True)
+        self._lock = threading.Lock()
+        self._lock_path = os.path.join(self.root, self.WORK_DIR, "lock")
+
+    def reset_after_fork(self):
+        """ The parent's lock may have been held by one of its threads, which the child does not have """
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock, open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep) or key.startswith(self.WORK_DIR):
+            raise StorageError(f"Invalid key: {key}")
+        return path
+
+    @staticmethod
+    def _describe(stat):
+        return {
+            "ContentLength": stat.st_size,
+            "ETag": f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+            "LastModified": datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+        }
+
+    def get(self, key, byte_range=None, if_none_match=None):
+        try:
+            file = open(self._path(key), "rb")
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            raise NotFound(key)
+        with file:
+            obj = self._describe(os.fstat(file.fileno()))
+            if if_none_match and if_none_match == obj["ETag"]:
+                raise NotModified(key)
+            size = obj["ContentLength"]
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+        start, end = 0, size
+        if byte_range:
+            start, end = min(byte_range[0], size), min(byte_range[1] + 1, size)
+        obj["ContentLength"] = end - start
+        obj["Body"] = MappedBody(mapped, start, end)
+        return obj
+
+    def head(self, key):
+        try:
+            return self._describe(os.stat(self._path(key)))
+        except (FileNotFoundError, NotADirectoryError):
+            raise NotFound(key)
+
+    def _write(self, key, write, if_match=None, if_none_match=None):
+        """ Writes an object through a temporary file renamed into place; returns its ETag """
+        path = self._path(key)
+        with tempfile.NamedTemporaryFile(dir=os.path.join(self.root, self.WORK_DIR), delete=False) as file:
+            write(file)
+        # The rename keeps the inode and times, so the ETag is known before the file is visible
+        etag = self._describe(os.stat(file.name))["ETag"]
+        try:
+            with self._locked():
+                if if_match or if_none_match:
+                    try:
+                        current = self.head(key)["ETag"]
+                    except NotFound:
+                        current = None
+                    if (if_match and current != if_match) or (if_none_match and current is not None):
+                        raise PreconditionFailed(key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(file.name, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(file.name)
+            raise
+        return etag
+
+    def put(self, key, body, content_type=None, if_match=None, if_none_match=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            write = lambda file: file.write(body)
+        else:
+            write = lambda file: shutil.copyfileobj(body, file)
+        return {"ETag": self._write(key, write, if_match, if_none_match)}
+
+    def upload_fileobj(self, stream, key):
+        self.put(key, stream)
+
+    def list(self, prefix, delimiter=None, start_after=None):
+        """ Yields a single page of objects (and sub-prefixes with a delimiter) in key order """
+        base = os.path.dirname(prefix)
+        directory = os.path.join(self.root, base)
+        contents, prefixes = [], []
+        for current, directories, files in os.walk(directory):
+            relative = os.path.relpath(current, self.root)
+            relative = "" if relative == "." else relative.replace(os.sep, "/") + "/"
+            if relative.startswith(self.WORK_DIR):
+                directories[:] = []
+                continue
+            if delimiter:
+                prefixes.extend(
+                    f"{relative}{name}/" for name in directories if f"{relative}{name}/".startswith(prefix)
+                )
+                directories[:] = []
+            for name in files:
+                key = f"{relative}{name}"
+                if key.startswith(prefix) and (not start_after or key > start_after):
+                    try:
+                        contents.append({"Key": key, **self._describe(os.stat(os.path.join(current, name)))})
+                    except FileNotFoundError:
+                        continue
+        for obj in contents:
+            obj["Size"] = obj.pop("ContentLength")
+        yield {
+            "Contents": sorted(contents, key=lambda obj: obj["Key"]),
+            "CommonPrefixes": [{"Prefix": name} for name in sorted(prefixes)]
+        }
+
+    def delete(self, keys):
+        """ Deletes files, then any directories the deletes left empty """
+        directories = set()
+        for key in keys:
+            path = self._path(key)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            directories.add(os.path.dirname(path))
+        # Under the lock so a directory is not removed between a writer creating it and renaming into it
+        with self._locked():
+            for directory in sorted(directories, key=len, reverse=True):
+                while directory != self.root:
+                    try:
+                        os.rmdir(directory)
+                    except OSError:
+                        break
+                    directory = os.path.dirname(directory)
+
+    def _parts_dir(self, upload_id):
+        return os.path.join(self.root, self.WORK_DIR, f"upload-{upload_id}")
+
+    def create_multipart_upload(self, key, content_type):
+        self._path(key)
+        upload_id = uuid.uuid4().hex
+        os.makedirs(self._parts_dir(upload_id))
+        return upload_id
+
+    def upload_part(self, key, upload_id, part_number, data):
+        with open(os.path.join(self._parts_dir(upload_id), str(part_number)), "wb") as file:
+            file.write(data)
+        return f'"{hashlib.md5(data).hexdigest()}"'
+
+    def complete_multipart_upload(self, key, upload_id, parts):
+        parts_dir = self._parts_dir(upload_id)
+
+        def concatenate(file):
+            for part in parts:
+                with open(os.path.join(parts_dir, str(part["PartNumber"])), "rb") as part_file:
+                    shutil.copyfileobj(part_file, file)
+
+        self._write(key, concatenate)
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+    def abort_multipart_upload(self, key, upload_id):
+        shutil.rmtree(self._parts_dir(upload_id), ignore_errors=True)
+
+    def url(self, key):
+        return f"file://{self._path(key)}"
+
+    def presigned_url(self, key, expires_in):
+        """ Files cannot be presigned; callers serve them through the app instead """
+        return None
+
+
+def create_storage():
+    """ Selects the storage backend configured by STORAGE_BACKEND (s3 or local) """
+    if STORAGE_BACKEND == "s3":
+        return S3Storage(S3_BUCKET)
+    if STORAGE_BACKEND == "local":
+        return LocalStorage(LOCAL_STORAGE_PATH)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
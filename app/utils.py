@@ -1 +1,8 @@
-# Add helper functions here
+import hashlib
+
+def calculate_checksum_from_body(body):
+    """ Calculate the MD5 checksum from a stream body """
+    md5 = hashlib.md5()
+    for chunk in body.iter_chunks(8192):
+        md5.update(chunk)
+    return md5.hexdigest()
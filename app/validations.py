@@ -1,14 +1,26 @@
 import re
 import json
+from app.config import ISSN_IDENTIFIER_COLUMNS
+
+ISSN_REGEX = r"^[0-9]{4}-[0-9]{3}[0-9X]$"
+ISSN_PATTERN = re.compile(ISSN_REGEX)
+
+REQUIRED_HEADINGS = [
+    "print_identifier",
+    "online_identifier",
+    "publication_title",
+    "publication_type"
+]
+
+# Weights of the first seven ISSN digits in the check digit calculation
+ISSN_WEIGHTS = (8, 7, 6, 5, 4, 3, 2)
 
 def is_valid_issn(issn):
     """
     Validate an ISSN (International Standard Serial Number).
     Returns True if valid, False otherwise.
     """
-    issn_pattern = re.compile(r"^\d{4}-\d{3}[\dX]$")
-
-    if not issn_pattern.match(issn):
+    if not ISSN_PATTERN.match(issn):
         return False  # Format is incorrect
 
     return True
@@ -21,24 +33,18 @@ def is_valid_issn_checksum(issn):
 
     return check_digit == digits[-1] or (check_digit == 10 and digits[-1] == "X")
 
-def validate_json(json_data):
+def validate_records(json_data, start=0):
     """
-    Validate JSON after conversion from TSV.
-    Ensures each object has a valid 'print_identifier' field.
+    Validate a batch of rows after conversion from TSV.
+    Rows are numbered from start so that chunks of a file report file-level row numbers.
+    Returns the lists of errors and warnings.
     """
     errors = []
     warnings = []
 
-    required_headings = [
-        "print_identifier",
-        "online_identifier",
-        "publication_title",
-        "publication_type"
-    ]
-
-    for i, entry in enumerate(json_data):
+    for i, entry in enumerate(json_data, start):
         entry_keys = entry.keys()
-        for heading in required_headings:
+        for heading in REQUIRED_HEADINGS:
             if heading not in entry_keys:
                 errors.append({"row": i, "error": f"Missing required heading", "data": heading})
         issn = entry.get("print_identifier")
@@ -47,6 +53,97 @@ def validate_json(json_data):
         if issn and not is_valid_issn_checksum(issn):
             warnings.append({"row": i, "warning": f"ISSN check digit does not match", "data": issn})
 
+    return errors, warnings
+
+def issn_check_digits_match(issns):
+    """
+    Vectorised ISSN check digit validation.
+    - issns: list of well formed ISSN strings ("1234-567X")
+    Returns a boolean array, True where the check digit matches.
+    """
+    import numpy as np
+
+    if not issns:
+        return np.zeros(0, dtype=bool)
+
+    # View the ASCII characters as an (n, 9) matrix, hyphen included
+    chars = np.frombuffer("".join(issns).encode("ascii"), dtype=np.uint8).reshape(-1, 9)
+    digits = chars[:, [0, 1, 2, 3, 5, 6, 7]].astype(np.int64) - ord("0")
+    last = chars[:, 8]
+    expected = (11 - (digits @ ISSN_WEIGHTS) % 11) % 11
+
+    return np.where(last == ord("X"), expected == 10, expected == last.astype(np.int64) - ord("0"))
+
+def validate_dataframe(df, start=0):
+    """
+    Validate a parsed TSV without converting it row by row.
+    Required headings are checked once per file and reported against its first row;
+    ISSN format and check digits are validated column-wise for ISSN_IDENTIFIER_COLUMNS.
+    Rows are numbered from start so that chunks of a file report file-level row numbers.
+    Returns the lists of errors and warnings in the same shape as validate_records.
+    """
+    import numpy as np
+
+    errors = []
+    warnings = []
+
+    if start == 0 and len(df):
+        for heading in REQUIRED_HEADINGS:
+            if heading not in df.columns:
+                errors.append({"row": 0, "error": "Missing required heading", "data": heading})
+
+    for column in ISSN_IDENTIFIER_COLUMNS:
+        if column not in df.columns:
+            continue
+
+        values = df[column]
+        present = (values.notna() & (values.astype(str) != "")).to_numpy()
+        present_values = values[present]
+
+        text = present_values.astype(str)
+        well_formed = text.str.match(ISSN_REGEX).to_numpy()
+        check_digits = np.zeros(len(text), dtype=bool)
+        check_digits[well_formed] = issn_check_digits_match(text[well_formed].tolist())
+
+        rows = np.flatnonzero(present) + start
+        invalid = np.flatnonzero(~well_formed)
+        for row, issn in zip(rows[invalid].tolist(), present_values.iloc[invalid].tolist()):
+            errors.append({"row": row, "error": "Invalid ISSN", "data": issn})
+        mismatched = np.flatnonzero(well_formed & ~check_digits)
+        for row, issn in zip(rows[mismatched].tolist(), present_values.iloc[mismatched].tolist()):
+            warnings.append({"row": row, "warning": "ISSN check digit does not match", "data": issn})
+
+    errors.sort(key=lambda error: error["row"])
+    warnings.sort(key=lambda warning: warning["row"])
+    return errors, warnings
+
+def normalize_issns(values):
+    """
+    Vectorised ISSN normalization for index keys.
+    Returns the values of a Series that are ISSNs once case, spaces and hyphens
+    are ignored, in the canonical "1234-567X" form.
+    """
+    text = values.dropna().astype(str).str.upper().str.replace(r"[\s-]", "", regex=True)
+    text = text[text.str.match(r"^[0-9]{7}[0-9X]$")]
+    return text.str[:4] + "-" + text.str[4:]
+
+def normalize_issn(issn):
+    """ Returns a single ISSN in the canonical "1234-567X" form, or None if it is not one """
+    text = re.sub(r"[\s-]", "", str(issn)).upper()
+    if not re.match(r"^[0-9]{7}[0-9X]$", text):
+        return None
+    return f"{text[:4]}-{text[4:]}"
+
+def validate_json(json_data):
+    """
+    Validate JSON after conversion from TSV.
+    Ensures each object has a valid 'print_identifier' field.
+    """
+    errors, warnings = validate_records(json_data)
+    return format_validation_result(errors, warnings)
+
+def format_validation_result(errors, warnings):
+    """ Packs error and warning lists into the (is_valid, errors, warnings) tuple of validate_json """
     if errors and warnings:
         return (False, json.dumps(errors), json.dumps(warnings))
     if errors:
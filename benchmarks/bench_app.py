@@ -0,0 +1,276 @@
+"""
+End-to-end benchmarks of the Flask app on synthetic KBART packages.
+
+    python -m benchmarks.bench_app --sizes 1000,10000,100000 --catalogue 10,100 --output results.json
+    python -m benchmarks.bench_app --baseline results.json --tolerance 0.2
+
+The app from app.create_app() is driven through Flask's test client against
+a throwaway local storage directory (--storage local, the default) or a moto
+S3 mock (--storage moto), so no MinIO is needed. For validation, ingest,
+package listing and package fetch it reports p50/p99 latency, throughput and
+the peak Python heap while running the operation once more under tracemalloc
+(allocations made by pyarrow's own allocator are not traced; max_rss_mb in
+the environment block covers the whole run). Results are written as JSON;
+with --baseline, a p50 slower than the baseline's by more than --tolerance is
+listed under "regressions" and the exit status is 1.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from importlib import metadata
+import numpy as np
+import pandas as pd
+from benchmarks.kbart import synthetic_tsv
+
+def configure_storage(args, directory):
+    """ Points the app at the benchmark storage; must run before app is imported """
+    os.environ.setdefault("S3_BUCKET", "benchmark-bucket")
+    os.environ["ASYNC_UPLOADS"] = "false"
+    os.environ["JOB_BACKEND"] = "memory"
+    if args.storage == "local":
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["LOCAL_STORAGE_PATH"] = directory
+        return None
+
+    from moto import mock_aws
+    import boto3
+    os.environ["STORAGE_BACKEND"] = "s3"
+    for name in ("AWS_ACCESS_KEY", "AWS_SECRET_KEY", "AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        os.environ.setdefault(name, "benchmark")
+    os.environ.setdefault("AWS_REGION", "us-east-1")
+    mock = mock_aws()
+    mock.start()
+    boto3.client("s3", region_name=os.environ["AWS_REGION"]).create_bucket(Bucket=os.environ["S3_BUCKET"])
+    return mock
+
+def summary(latencies):
+    """ Latency percentiles in milliseconds """
+    milliseconds = np.array(latencies) * 1000
+    return {
+        "p50": round(float(np.percentile(milliseconds, 50)), 3),
+        "p99": round(float(np.percentile(milliseconds, 99)), 3),
+        "mean": round(float(milliseconds.mean()), 3),
+        "min": round(float(milliseconds.min()), 3),
+        "max": round(float(milliseconds.max()), 3)
+    }
+
+def measure(benchmark, call, repeat, units=None, **labels):
+    """
+    Times call() repeat times, then runs it once more under tracemalloc.
+    - units: {"rows": n, "bytes": n} processed per call, reported per second
+    """
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {
+        "benchmark": benchmark,
+        **labels,
+        "iterations": repeat,
+        "latency_ms": summary(latencies),
+        "throughput": {"requests_per_s": round(repeat / sum(latencies), 2)},
+        "peak_memory_mb": round(peak / 2 ** 20, 2)
+    }
+    for unit, count in (units or {}).items():
+        result["throughput"][f"{unit}_per_s"] = round(count * repeat / sum(latencies), 1)
+    print(f"{benchmark} {labels}: p50 {result['latency_ms']['p50']} ms", file=sys.stderr)
+    return result
+
+def request(client, method, url, expected=(200,), **kwargs):
+    """ Sends a request and reads the whole body, failing on an unexpected status """
+    response = client.open(url, method=method, **kwargs)
+    body = response.get_data()
+    response.close()
+    if response.status_code not in expected:
+        raise RuntimeError(f"{method} {url} returned {response.status_code}: {body[:200]!r}")
+    return response, body
+
+def upload(client, tsv, name):
+    response, body = request(
+        client, "POST", "/upload",
+        data={"file": (io.BytesIO(tsv), f"{name}.tsv"), "package_name": name},
+        content_type="multipart/form-data"
+    )
+    return json.loads(body)["package_id"]
+
+def bench_validation(args, sizes):
+    from app.validations import validate_dataframe, validate_json
+
+    results = []
+    for rows in sizes:
+        tsv = synthetic_tsv(rows, args.bad_issn_rate, args.seed)
+        frame = pd.read_csv(io.BytesIO(tsv), sep="\t")
+        results.append(measure(
+            "validate_dataframe", lambda: validate_dataframe(frame), args.repeat, {"rows": rows}, rows=rows
+        ))
+        if rows <= args.legacy_max_rows:
+            records = json.loads(frame.to_json(orient="records"))
+            results.append(measure(
+                "validate_json", lambda: validate_json(records), args.repeat, {"rows": rows}, rows=rows
+            ))
+    return results
+
+def bench_ingest_and_fetch(args, client, sizes):
+    results = []
+    for rows in sizes:
+        tsv = synthetic_tsv(rows, args.bad_issn_rate, args.seed)
+        package_ids = []
+        results.append(measure(
+            "ingest", lambda: package_ids.append(upload(client, tsv, f"bench-{rows}")),
+            args.repeat, {"rows": rows, "bytes": len(tsv)}, rows=rows
+        ))
+
+        package_id = package_ids[0]
+        results.append(measure(
+            "get_package", lambda: request(client, "GET", f"/package/{package_id}"),
+            args.repeat, {"rows": rows}, rows=rows
+        ))
+        results.append(measure(
+            "get_package_gzip",
+            lambda: request(client, "GET", f"/package/{package_id}", headers={"Accept-Encoding": "gzip"}),
+            args.repeat, {"rows": rows}, rows=rows
+        ))
+        results.append(measure(
+            "get_package_page", lambda: request(client, "GET", f"/package/{package_id}?offset={rows // 2}&limit=100"),
+            args.repeat, rows=rows
+        ))
+    return results
+
+def bench_catalogue(args, client, targets):
+    """ Grows the catalogue with small packages and measures listing and fetch at each size """
+    results = []
+    tsv = synthetic_tsv(args.catalogue_rows, args.bad_issn_rate, args.seed)
+    package_ids = []
+    for target in targets:
+        while len(package_ids) < target:
+            package_ids.append(upload(client, tsv, f"catalogue-{len(package_ids)}"))
+
+        rng = np.random.default_rng(args.seed)
+        results.append(measure(
+            "list_packages_all", lambda: request(client, "GET", "/packages?all=true"),
+            args.repeat, packages=len(package_ids)
+        ))
+        results.append(measure(
+            "list_packages_page", lambda: request(client, "GET", "/packages?page=1&per_page=100"),
+            args.repeat, packages=len(package_ids)
+        ))
+        results.append(measure(
+            "get_package_random",
+            lambda: request(client, "GET", f"/package/{package_ids[rng.integers(len(package_ids))]}"),
+            args.repeat, packages=len(package_ids)
+        ))
+    return results
+
+def environment(args):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    versions = {}
+    for package in ("flask", "pandas", "numpy", "pyarrow", "boto3"):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "packages": versions,
+        "arguments": vars(args),
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        "max_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 1
+        )
+    }
+
+def result_key(result):
+    return tuple(sorted((key, value) for key, value in result.items() if key in ("benchmark", "rows", "packages")))
+
+def find_regressions(results, baseline, tolerance):
+    """ Lists results whose p50 latency exceeds the baseline's by more than tolerance """
+    baseline_results = {result_key(result): result for result in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get(result_key(result))
+        if not previous:
+            continue
+        before, after = previous["latency_ms"]["p50"], result["latency_ms"]["p50"]
+        if before and after > before * (1 + tolerance):
+            regressions.append({**dict(result_key(result)), "baseline_p50_ms": before, "p50_ms": after})
+    return regressions
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(",") if size]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=parse_sizes, default=[1000, 10000, 100000], help="rows per package, comma separated")
+    parser.add_argument("--catalogue", type=parse_sizes, default=[10, 100], help="catalogue sizes to measure listing at")
+    parser.add_argument("--catalogue-rows", type=int, default=100, help="rows per package used to grow the catalogue")
+    parser.add_argument("--bad-issn-rate", type=float, default=0.01)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--legacy-max-rows", type=int, default=100000, help="largest size to run validate_json at")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--storage", choices=["local", "moto"], default="local")
+    parser.add_argument("--skip", default="", help="comma separated groups to skip: validation,ingest,catalogue")
+    parser.add_argument("--output", help="write results here instead of stdout")
+    parser.add_argument("--baseline", help="earlier results to compare p50 latencies with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    skip = set(args.skip.split(","))
+
+    with tempfile.TemporaryDirectory(prefix="microkb-bench-") as directory:
+        mock = configure_storage(args, directory)
+        # The app logs to stdout; keep stdout for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            from app import create_app
+            client = create_app().test_client()
+
+            results = []
+            if "validation" not in skip:
+                results += bench_validation(args, args.sizes)
+            if "catalogue" not in skip:
+                results += bench_catalogue(args, client, args.catalogue)
+            if "ingest" not in skip:
+                results += bench_ingest_and_fetch(args, client, args.sizes)
+        if mock:
+            mock.stop()
+
+    report = {"environment": environment(args), "results": results}
+    if args.baseline:
+        with open(args.baseline) as file:
+            report["regressions"] = find_regressions(results, json.load(file), args.tolerance)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    return 1 if report.get("regressions") else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
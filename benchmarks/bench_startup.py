@@ -0,0 +1,130 @@
+"""
+Worker cold start benchmark: import time, create_app() time, first request
+latency and resident memory of a fresh process.
+
+    python -m benchmarks.bench_startup --repeat 5 --packages 100 --output startup.json
+
+Each sample runs in a new interpreter against a throwaway local storage
+directory holding a synthetic catalogue, once with WARM_UP off and once with
+it on. Besides the timings, every sample records whether pandas, pyarrow and
+boto3 had been imported by the time the first GET /packages was answered and
+the RSS of the process after each step (read from /proc, so Linux only).
+getrusage is not used: a child's peak RSS includes that of the parent it
+was forked from.
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import numpy as np
+from benchmarks.bench_app import configure_storage, summary, environment
+from benchmarks.kbart import synthetic_tsv
+
+HEAVY_MODULES = ("pandas", "pyarrow", "boto3")
+
+SAMPLE = """
+import json, sys, time
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+
+start = time.perf_counter()
+rss = {"interpreter": rss_mb()}
+from app import create_app
+imported = time.perf_counter()
+rss["import"] = rss_mb()
+app = create_app(warm_up=WARM_UP)
+created = time.perf_counter()
+rss["create_app"] = rss_mb()
+response = app.test_client().get("/packages")
+response.get_data()
+answered = time.perf_counter()
+rss["first_request"] = rss_mb()
+print(json.dumps({
+    "import_s": imported - start,
+    "create_app_s": created - imported,
+    "first_request_s": answered - created,
+    "status": response.status_code,
+    "rss_mb": rss,
+    "loaded": {module: module in sys.modules for module in HEAVY_MODULES}
+}))
+"""
+
+def seed_catalogue(args):
+    """ Uploads args.packages small packages through the app, in this process """
+    from contextlib import redirect_stdout
+    with redirect_stdout(sys.stderr):
+        from app import create_app
+        client = create_app(warm_up=False).test_client()
+        tsv = synthetic_tsv(args.package_rows, seed=args.seed)
+        for i in range(args.packages):
+            response = client.post(
+                "/upload",
+                data={"file": (io.BytesIO(tsv), f"startup-{i}.tsv"), "package_name": f"startup-{i}"},
+                content_type="multipart/form-data"
+            )
+            if response.status_code != 200:
+                raise RuntimeError(f"Seeding failed: {response.get_data(as_text=True)[:200]}")
+
+def sample(warm_up):
+    """ Starts a fresh interpreter, builds the app and answers one request """
+    code = SAMPLE.replace("WARM_UP", repr(warm_up)).replace("HEAVY_MODULES", repr(HEAVY_MODULES))
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def report(warm_up, samples):
+    stages = {}
+    for stage in ("import_s", "create_app_s", "first_request_s"):
+        stages[stage.replace("_s", "_ms")] = summary([sample[stage] for sample in samples])
+    rss = {
+        step: round(float(np.median([sample["rss_mb"][step] for sample in samples])), 1)
+        for step in samples[0]["rss_mb"] if samples[0]["rss_mb"][step] is not None
+    }
+    result = {
+        "benchmark": "cold_start",
+        "warm_up": warm_up,
+        "iterations": len(samples),
+        "latency_ms": summary([sample["import_s"] + sample["create_app_s"] + sample["first_request_s"] for sample in samples]),
+        "stages": stages,
+        "median_rss_mb": rss,
+        "loaded_by_first_request": samples[-1]["loaded"]
+    }
+    print(f"cold_start warm_up={warm_up}: p50 {result['latency_ms']['p50']} ms, rss {rss}", file=sys.stderr)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--packages", type=int, default=100, help="packages in the catalogue")
+    parser.add_argument("--package-rows", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results here instead of stdout")
+    args = parser.parse_args()
+    args.storage = "local"
+
+    with tempfile.TemporaryDirectory(prefix="microkb-startup-") as directory:
+        configure_storage(args, directory)
+        seed_catalogue(args)
+        results = [report(warm_up, [sample(warm_up) for _ in range(args.repeat)]) for warm_up in (False, True)]
+
+    output = json.dumps({"environment": environment(args), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Synthetic KBART title lists for benchmarks.
+
+    python -m benchmarks.kbart --rows 1000000 --bad-issn-rate 0.01 > titles.tsv
+"""
+import argparse
+import sys
+import numpy as np
+import pandas as pd
+
+ISSN_WEIGHTS = np.array([8, 7, 6, 5, 4, 3, 2])
+
+KBART_COLUMNS = [
+    "publication_title", "print_identifier", "online_identifier", "date_first_issue_online",
+    "num_first_vol_online", "num_first_issue_online", "date_last_issue_online", "num_last_vol_online",
+    "num_last_issue_online", "title_url", "first_author", "title_id", "embargo_info", "coverage_depth",
+    "notes", "publisher_name", "publication_type"
+]
+
+def synthetic_issns(rows, bad_issn_rate, seed=0):
+    """ Generates ISSNs with valid check digits, corrupting the check digit of a share of them """
+    rng = np.random.default_rng(seed)
+    digits = rng.integers(0, 10, size=(rows, 7))
+    check = (11 - (digits @ ISSN_WEIGHTS) % 11) % 11
+    bad = rng.random(rows) < bad_issn_rate
+    check[bad] = (check[bad] + 1) % 11
+
+    chars = np.empty((rows, 9), dtype=np.uint8)
+    chars[:, :4] = digits[:, :4] + ord("0")
+    chars[:, 4] = ord("-")
+    chars[:, 5:8] = digits[:, 4:] + ord("0")
+    chars[:, 8] = np.where(check == 10, ord("X"), check + ord("0"))
+    return chars.view("S9").ravel().astype(str)
+
+def synthetic_frame(rows, bad_issn_rate=0.0, seed=0):
+    """ Builds a KBART title list as a DataFrame; the same arguments always give the same rows """
+    rng = np.random.default_rng(seed + 2)
+    index = pd.Series(np.arange(rows)).astype(str)
+    first_year = rng.integers(1950, 2020, size=rows)
+    return pd.DataFrame({
+        "publication_title": "Journal of Synthetic Studies " + index,
+        "print_identifier": synthetic_issns(rows, bad_issn_rate, seed),
+        "online_identifier": synthetic_issns(rows, bad_issn_rate, seed + 1),
+        "date_first_issue_online": pd.Series(first_year).astype(str) + "-01-01",
+        "num_first_vol_online": first_year - 1949,
+        "num_first_issue_online": 1,
+        "date_last_issue_online": "",
+        "num_last_vol_online": "",
+        "num_last_issue_online": "",
+        "title_url": "https://example.org/journals/" + index,
+        "first_author": "",
+        "title_id": np.arange(rows),
+        "embargo_info": np.where(rng.random(rows) < 0.2, "R1Y", ""),
+        "coverage_depth": "fulltext",
+        "notes": "",
+        "publisher_name": "Publisher " + pd.Series(rng.integers(0, 500, size=rows)).astype(str),
+        "publication_type": "serial"
+    }, columns=KBART_COLUMNS)
+
+def synthetic_tsv(rows, bad_issn_rate=0.0, seed=0):
+    """ Returns a KBART title list as TSV bytes, as a provider would upload it """
+    return synthetic_frame(rows, bad_issn_rate, seed).to_csv(sep="\t", index=False).encode("utf-8")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--bad-issn-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    sys.stdout.buffer.write(synthetic_tsv(args.rows, args.bad_issn_rate, args.seed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Concurrent ingest check: parallel uploads of one package, new packages and
+deletes, followed by a consistency check of everything they wrote.
+
+    python -m benchmarks.stress_concurrency --storage moto --workers 8 --versions 24 --packages 16
+
+The app is driven through Flask's test client, one client per worker thread,
+against a moto S3 mock (which honours If-Match / If-None-Match on PUT) or a
+throwaway local storage directory. Afterwards:
+
+- every upload of the shared package got its own version number, and all of
+  them are recorded in its metadata.json with the highest as latest
+- the package list holds every remaining package once, at the revision of
+  its metadata.json, and none of the deleted ones
+- the title index points every ISSN indexed for a package at it, the package
+  is indexed at its latest version, and nothing points at deleted packages
+- the index writers needed fewer batches than the changes submitted to them
+
+The report is printed as JSON; the exit status is 1 if any check failed.
+"""
+import argparse
+import contextlib
+import io
+import json
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.bench_app import configure_storage, summary, environment
+from benchmarks.kbart import synthetic_tsv
+
+SHARED_PACKAGE = "stress-shared"
+
+def serialize_mock():
+    """
+    Makes the in-process moto mock apply one request at a time, as S3 applies
+    each PUT atomically. Unserialized, moto checks If-Match and stores the
+    object as separate steps, and can read the buffer of an object another
+    thread is replacing.
+    """
+    from moto.core.botocore_stubber import BotocoreStubber
+    lock = threading.Lock()
+    call = BotocoreStubber.__call__
+
+    def serialized(self, event_name, request, **kwargs):
+        with lock:
+            return call(self, event_name, request, **kwargs)
+    BotocoreStubber.__call__ = serialized
+
+def upload(client, tsv, name, package_id=None):
+    data = {"file": (io.BytesIO(tsv), f"{name}.tsv"), "package_name": name}
+    if package_id:
+        data["package_id"] = package_id
+    response = client.post(
+        "/upload",
+        data=data,
+        content_type="multipart/form-data"
+    )
+    body = response.get_json()
+    if response.status_code != 200:
+        raise RuntimeError(f"Upload of {name} returned {response.status_code}: {body}")
+    return body
+
+def run_load(args, flask_app):
+    """ Runs the uploads and deletes; returns the shared package's versions, the surviving and deleted packages """
+    def task(kind, n):
+        client = flask_app.test_client()
+        # Seeds differ per upload so none of them is deduplicated against another
+        tsv = synthetic_tsv(args.rows, seed=args.seed + n)
+        start = time.perf_counter()
+        if kind == "version":
+            result = upload(client, tsv, SHARED_PACKAGE, SHARED_PACKAGE)["version"]
+        else:
+            package_id = upload(client, tsv, f"stress-{n}")["package_id"]
+            if kind == "delete":
+                response = client.delete(f"/package/{package_id}")
+                if response.status_code != 200:
+                    raise RuntimeError(f"Delete of {package_id} returned {response.status_code}")
+            result = package_id
+        return kind, result, time.perf_counter() - start
+
+    tasks = [("version", n) for n in range(args.versions)]
+    tasks += [("delete" if n % args.delete_every == 0 else "package", args.versions + n) for n in range(args.packages)]
+    # Interleave the kinds so every phase of one upload overlaps the others
+    tasks.sort(key=lambda task: task[1] % args.workers)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        outcomes = list(pool.map(lambda task_args: task(*task_args), tasks))
+
+    versions = [result for kind, result, elapsed in outcomes if kind == "version"]
+    packages = [result for kind, result, elapsed in outcomes if kind == "package"] + [SHARED_PACKAGE]
+    deleted = [result for kind, result, elapsed in outcomes if kind == "delete"]
+    return versions, packages, deleted, [elapsed for kind, result, elapsed in outcomes]
+
+def fresh_json(key):
+    """ Reads a JSON object from storage, bypassing the cache """
+    from app.services import metadata_cache
+    return metadata_cache.get(key, max_age=0)[0]
+
+def check(versions, packages, deleted):
+    """ Returns the failed checks, as messages """
+    from app.config import PACKAGE_LIST_SHARDS
+    from app.services import PACKAGE_LIST_PREFIX, TITLE_INDEX_PREFIX, title_keys_key, list_objects
+
+    failures = []
+    if len(set(versions)) != len(versions):
+        failures.append(f"Version numbers given out more than once: {sorted(versions)}")
+    metadata = fresh_json(f"packages/{SHARED_PACKAGE}/metadata.json")
+    recorded = sorted(int(version) for version in metadata["versions"])
+    if recorded != sorted(set(versions)):
+        failures.append(f"Versions uploaded {sorted(versions)} but recorded {recorded}")
+    if metadata["latest"] != max(versions):
+        failures.append(f"Latest is {metadata['latest']}, expected {max(versions)}")
+
+    listed = {}
+    for shard in range(PACKAGE_LIST_SHARDS):
+        for entry in (fresh_json(f"{PACKAGE_LIST_PREFIX}{shard:02x}.json") or {}).get("packages", []):
+            if entry["identifier"] in listed:
+                failures.append(f"Package {entry['identifier']} is listed twice")
+            listed[entry["identifier"]] = entry
+    revisions = {package_id: fresh_json(f"packages/{package_id}/metadata.json") for package_id in packages}
+    for package_id, package_metadata in revisions.items():
+        entry = listed.get(package_id)
+        if entry is None:
+            failures.append(f"Package {package_id} is missing from the package list")
+        elif entry.get("revision") != package_metadata.get("revision"):
+            failures.append(f"Package {package_id} is listed at revision {entry.get('revision')}, metadata is at {package_metadata.get('revision')}")
+    for package_id in set(listed) & set(deleted):
+        failures.append(f"Deleted package {package_id} is still listed")
+
+    manifests = {package_id: fresh_json(title_keys_key(package_id)) for package_id in packages}
+    expected = {(issn, package_id) for package_id, manifest in manifests.items() for issn in manifest["issns"]}
+    for package_id, manifest in manifests.items():
+        if manifest["version"] != revisions[package_id]["latest"]:
+            failures.append(f"Package {package_id} is indexed at version {manifest['version']}, latest is {revisions[package_id]['latest']}")
+    indexed = set()
+    for obj in list_objects(TITLE_INDEX_PREFIX):
+        issn = obj["Key"][len(TITLE_INDEX_PREFIX):-len(".json")]
+        indexed |= {(issn, package_id) for package_id in fresh_json(obj["Key"])["packages"]}
+    if indexed != expected:
+        failures.append(
+            f"Title index has {len(indexed - expected)} unexpected and {len(expected - indexed)} missing entries, "
+            f"e.g. {sorted(indexed - expected)[:3]} / {sorted(expected - indexed)[:3]}"
+        )
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--storage", choices=["local", "moto"], default="moto")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--versions", type=int, default=24, help="concurrent uploads of the shared package")
+    parser.add_argument("--packages", type=int, default=16, help="uploads of new packages")
+    parser.add_argument("--delete-every", type=int, default=4, help="delete every nth new package again")
+    parser.add_argument("--rows", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="microkb-stress-") as directory:
+        mock = configure_storage(args, directory)
+        if mock:
+            serialize_mock()
+        with contextlib.redirect_stdout(sys.stderr):
+            from app import create_app
+            from app.services import package_list_writer, title_index_writer
+            flask_app = create_app(warm_up=False)
+            versions, packages, deleted, latencies = run_load(args, flask_app)
+            failures = check(versions, packages, deleted)
+        if mock:
+            mock.stop()
+
+    writers = {
+        writer.name: {"submitted": writer.submitted, "batches": writer.batches}
+        for writer in (package_list_writer, title_index_writer)
+    }
+    for name, counts in writers.items():
+        if counts["batches"] >= counts["submitted"]:
+            failures.append(f"{name} wrote {counts['batches']} batches for {counts['submitted']} changes")
+
+    print(json.dumps({
+        "environment": environment(args),
+        "uploads": len(latencies),
+        "latency_ms": summary(latencies),
+        "writers": writers,
+        "failures": failures
+    }, indent=2))
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
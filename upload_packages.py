@@ -1,65 +1,192 @@
+import argparse
+import json
+import os
+import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-import os
-import json
 
 # Constants
 KBPLUS_URL = "https://www.kbplus.ac.uk/kbplus7/publicExport/idx?format=json&max=3"
-MICROKB_UPLOAD_URL = "http://127.0.0.1:5000/upload"
+KBPLUS_EXPORT_URL = "https://www.kbplus.ac.uk/test2/publicExport/pkg/{package_id}?format=xml&transformId=kbart2"
+MICROKB_BATCH_URL = "http://127.0.0.1:5000/upload/batch"
+# Each KB+ package is loaded under a package ID derived from its identifier
+PACKAGE_ID_PREFIX = "kbplus-"
+
+
+class RateLimiter:
+    """ Token bucket allowing `rate` requests per second with bursts of up to `burst` """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Progress:
+    """ Resumable record of the KB+ package IDs already loaded, saved as JSON after every batch """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.completed = set()
+        if path and os.path.exists(path):
+            with open(path) as file:
+                self.completed = set(json.load(file).get("completed", []))
+
+    def mark(self, package_ids):
+        with self.lock:
+            self.completed.update(package_ids)
+            if not self.path:
+                return
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as file:
+                json.dump({"completed": sorted(self.completed)}, file)
+            os.replace(tmp_path, self.path)
+
+
+def with_retries(call, retries, limiter, description):
+    """
+    Runs call() under the rate limiter, retrying failures with exponential
+    backoff and jitter. 4xx responses other than 429 are not retried.
+    Only use it for calls that are safe to repeat: a request that timed out
+    or failed with a 5xx may still have been carried out.
+    """
+    for attempt in range(retries + 1):
+        limiter.acquire()
+        try:
+            return call()
+        except requests.RequestException as e:
+            status = e.response.status_code if e.response is not None else None
+            if attempt == retries or (status and 400 <= status < 500 and status != 429):
+                raise
+            delay = min(60, 2 ** attempt) * (0.5 + random.random())
+            print(f"{description} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
 
-def fetch_packages():
-    response = requests.get(KBPLUS_URL)
+def fetch_packages(session):
+    response = session.get(KBPLUS_URL)
     response.raise_for_status()
     return response.json().get("packages", [])
 
-def download_csv(url, filename):
-    response = requests.get(url)
+def download_package(session, package_id):
+    """ Downloads a package's KBART export into memory """
+    response = session.get(KBPLUS_EXPORT_URL.format(package_id=package_id))
     response.raise_for_status()
-    with open(filename, 'wb') as file:
-        file.write(response.content)
-
-def upload_package(file_path, package_id, package_name):
-    with open(file_path, 'rb') as file:
-        response = requests.post(
-            MICROKB_UPLOAD_URL,
-            files={"file": file},
-            data={"additional_identifiers": json.dumps([{"type": "kbplus", "identifier": package_id}]), "package_name": package_name}
-        )
+    return response.content
+
+def microkb_package_id(package):
+    return f"{PACKAGE_ID_PREFIX}{package['identifier']}"
+
+def upload_batch(session, upload_url, batch):
+    """
+    POSTs a batch of (package, content) pairs to /upload/batch as a multipart list.
+    Every package is sent with its own package_id, so sending the same batch
+    again (after a timeout, say) deduplicates against the versions the first
+    attempt stored instead of creating new packages.
+    """
+    files = [("file", (f"{package['identifier']}.tsv", content)) for package, content in batch]
+    data = []
+    for package, _ in batch:
+        data.append(("package_name", package["name"]))
+        data.append(("package_id", microkb_package_id(package)))
+        data.append(("additional_identifiers", json.dumps([{"type": "kbplus", "identifier": package["identifier"]}])))
+    response = session.post(upload_url, files=files, data=data)
     response.raise_for_status()
     return response.json()
 
-def main():
-    packages = fetch_packages()
-    for package in packages:
-        time.sleep(1)
-        package_id = package["identifier"]
-        package_name = package["name"]
-        csv_url = package["packageContentAsCsv"]
-        csv_filename = f"{package_name}.csv"
-
-        print(f"Processing package: {package_name} (ID: {package_id})")
+def batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
-        # Download the CSV
+def load_batch(session, args, limiter, progress, batch):
+    """ Downloads a batch's packages concurrently, uploads them together and records which succeeded """
+    def download(package):
         try:
-            download_csv(f"https://www.kbplus.ac.uk/test2/publicExport/pkg/{package_id}?format=xml&transformId=kbart2", csv_filename)
+            content = with_retries(
+                lambda: download_package(session, package["identifier"]),
+                args.retries, limiter, f"Download of {package['name']}"
+            )
+            return package, content
         except Exception as e:
-            print(f"Failed to download CSV for package {package_name}: {e}")
+            print(f"Failed to download package {package['name']}: {e}")
+            return package, None
 
-        # Upload the package
-        count = 0
-        # while count < 500:
-        try:
-            response = upload_package(csv_filename, package_id, package_name)
-            count += 1
-            print(f"Uploaded package {package_name} successfully: {response}")
-        except Exception as e:
-            print(f"Failed to upload package {package_name}: {e}")
+    with ThreadPoolExecutor(max_workers=len(batch)) as pool:
+        downloaded = [item for item in pool.map(download, batch) if item[1]]
+    if not downloaded:
+        return 0
 
-        # Clean up the downloaded CSV file
-        try:
-            os.remove(csv_filename)
-        except Exception as e:
-            print(f"Failed to remove CSV file {csv_filename}: {e}")
+    try:
+        result = with_retries(
+            lambda: upload_batch(session, args.url, downloaded),
+            args.retries, limiter, f"Upload of batch of {len(downloaded)}"
+        )
+    except Exception as e:
+        print(f"Failed to upload batch of {len(downloaded)} packages: {e}")
+        return 0
+
+    uploaded = []
+    for (package, _), outcome in zip(downloaded, result["results"]):
+        if outcome["status"] == 200:
+            uploaded.append(package["identifier"])
+            print(f"Uploaded package {package['name']} successfully: {outcome.get('package_id')}")
+        else:
+            print(f"Failed to upload package {package['name']}: {outcome.get('error', outcome)}")
+    progress.mark(uploaded)
+    return len(uploaded)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Bulk load KB+ packages into microkb")
+    parser.add_argument("--url", default=MICROKB_BATCH_URL, help="microkb /upload/batch endpoint")
+    parser.add_argument("--workers", type=int, default=4, help="batches processed concurrently")
+    parser.add_argument("--batch-size", type=int, default=10, help="packages per upload request")
+    parser.add_argument("--rate", type=float, default=5, help="max requests per second, 0 for unlimited")
+    parser.add_argument("--retries", type=int, default=5, help="retries per request")
+    parser.add_argument("--progress", default="upload_progress.json", help="resumable progress file, empty to disable")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=args.workers, pool_maxsize=args.workers * args.batch_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    limiter = RateLimiter(args.rate, burst=args.workers)
+    progress = Progress(args.progress)
+
+    packages = [
+        package for package in fetch_packages(session)
+        if package["identifier"] not in progress.completed
+    ]
+    print(f"Loading {len(packages)} packages ({len(progress.completed)} already done)")
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        loaded = sum(pool.map(
+            lambda batch: load_batch(session, args, limiter, progress, batch),
+            batches(packages, args.batch_size)
+        ))
+    print(f"Loaded {loaded} of {len(packages)} packages")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()